@@ -0,0 +1,702 @@
+import os
+import re
+import sys
+import ast
+import json
+import time
+import random
+import socket
+import struct
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+
+# Runs server.py on loopback against a generated library and drives simulated clients through it:
+#   python benchmark.py --clients 50 --output results.json --compare previous.json
+
+# Must match streaming.py and the client
+PACKET_HEADER = struct.Struct("!2sBBII")  # magic, version, flags, stream id, sequence number
+PACKET_MAGIC = b"MS"
+FLAG_RETRANSMIT = 0x01
+FLAG_LAST = 0x02
+FLAG_PARITY = 0x04
+NACK_INTERVAL = 0.3  # seconds between requests for missing packets
+ACK_EVERY = 8  # packets between acks
+RECEIVE_PACKET_COST = 2 * 4096 + 1024  # socket buffer memory one queued packet takes
+MAX_NACK_LENGTH = 900
+
+# Generated songs: MPEG-1 layer III, 128 kbit/s, 44.1 kHz, mono frames of 417 bytes
+FRAME_HEADER = b"\xff\xfb\x90\xc4"
+FRAME_SIZE = 417
+FRAME_SECONDS = 1152 / 44100
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+REPLY_TIMEOUT = 30  # seconds a command may take before it counts as failed, logins queue behind bcrypt
+STREAM_TIMEOUT = 10  # seconds without a packet before a stream counts as failed
+RESUME_AFTER = 3  # seconds without a packet before a stream is asked to resume, as the client does
+RESUME_INTERVAL = 1
+RESUME_TIMEOUT = 60  # seconds without a packet before a resumable stream counts as failed
+STARTUP_TIMEOUT = 60
+BENCH_USER = ("bench", "bench@localhost", "bench-password")
+
+
+def make_library(folder, songs, seconds):  # Write songs of silence-free noise the server can index and seek
+    os.makedirs(folder, exist_ok=True)
+    frames = max(1, int(seconds / FRAME_SECONDS))
+    for index in range(songs):
+        body = bytearray(os.urandom(FRAME_SIZE - len(FRAME_HEADER)))
+        body = body.replace(b"\xff", b"\x00")  # no false frame syncs inside the audio
+        with open(os.path.join(folder, f"song {index:04d}.mp3"), 'wb') as file:
+            file.write((FRAME_HEADER + body) * frames)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values):  # Summary of latencies in milliseconds
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 2)
+    return {"count": len(values), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": at(1.0)}
+
+
+def process_cpu(pid):  # CPU seconds used by a process and its workers so far, None where /proc is missing
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")  # utime + stime
+    except (OSError, IndexError, ValueError):
+        return None
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            children = file.read().split()
+    except OSError:
+        children = []
+    return seconds + sum(process_cpu(child) or 0 for child in children)
+
+
+def listening(log_path):  # Server processes that have bound the port, from their startup lines
+    with open(log_path) as file:
+        return file.read().count(" listening on ")
+
+
+def udp_receive_drops():  # Datagrams the kernel dropped for full receive buffers, machine-wide, Linux only
+    try:
+        with open("/proc/net/snmp") as file:
+            rows = [line.split() for line in file if line.startswith("Udp:")]
+        return int(dict(zip(rows[0], rows[1]))["RcvbufErrors"])
+    except (OSError, IndexError, KeyError, ValueError):
+        return None
+
+
+def format_ranges(seqs):  # [4, 5, 9] -> "4-5,9", cut to fit one datagram
+    parts = []
+    start = prev = None
+    for seq in seqs + [None]:
+        if start is not None and (seq is None or seq != prev + 1):
+            parts.append(str(start) if start == prev else f"{start}-{prev}")
+            if sum(len(part) + 1 for part in parts) > MAX_NACK_LENGTH:
+                parts.pop()
+                break
+            start = None
+        if seq is not None and start is None:
+            start = seq
+        prev = seq
+    return ",".join(parts)
+
+
+class SmtpSink:  # Bare smtp server keeping every mail, stands in for the real mail server
+    def __init__(self):
+        self.mails = []  # (recipients, text)
+        self.arrived = asyncio.Event()
+        self.server = None
+        self.handlers = {}  # task -> writer of each open connection, the server's outbox keeps one
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.handlers[asyncio.current_task()] = writer
+        writer.write(b"220 benchmark\r\n")
+        recipients, lines, in_data = [], [], False
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if in_data:
+                if line.rstrip(b"\r\n") == b".":
+                    self.mails.append((recipients, b"".join(lines).decode(errors="replace")))
+                    self.arrived.set()
+                    recipients, lines, in_data = [], [], False
+                    writer.write(b"250 OK\r\n")
+                else:
+                    lines.append(line)
+                continue
+            verb = line[:4].upper()
+            if verb in (b"EHLO", b"HELO"):
+                writer.write(b"250 benchmark\r\n")
+            elif verb == b"RCPT":
+                recipients.append(line.split(b":", 1)[1].strip(b" <>\r\n").decode())
+                writer.write(b"250 OK\r\n")
+            elif verb == b"DATA":
+                in_data = True
+                writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            elif verb == b"QUIT":
+                writer.write(b"221 Bye\r\n")
+                break
+            else:
+                writer.write(b"250 OK\r\n")
+            await writer.drain()
+        writer.close()
+
+    async def wait_for_otp(self, email, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for recipients, text in self.mails:
+                match = re.search(r"Your OTP is (\d+)", text)
+                if email in recipients and match:
+                    return match.group(1)
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+        raise TimeoutError(f"no otp mailed to {email}")
+
+    async def close(self):
+        self.server.close()
+        for writer in self.handlers.values():
+            writer.close()  # the handler reads end of file and returns
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+
+class BenchClient(asyncio.DatagramProtocol):  # One simulated listener with its own socket
+    def __init__(self, loss=0.0):
+        self.transport = None
+        self.queue = asyncio.Queue()  # (arrival time, datagram)
+        self.loss = loss  # share of stream packets thrown away, to simulate a lossy link
+        self.offline_until = 0.0  # nothing gets in or out before this, to simulate a Wi-Fi drop
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if time.perf_counter() < self.offline_until:
+            return
+        if self.loss and data[:2] == PACKET_MAGIC and random.random() < self.loss:
+            return
+        self.queue.put_nowait((time.perf_counter(), data))
+
+    def send(self, *messages):
+        if time.perf_counter() < self.offline_until:
+            return
+        for message in messages:
+            self.transport.sendto(message.encode())
+
+    async def receive(self, timeout):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class Results:  # Everything measured during one run
+    def __init__(self):
+        self.latencies = {}  # command -> [seconds]
+        self.errors = {}  # command -> count
+        self.ttfb = []
+        self.completion = []
+        self.stream_bytes = 0
+        self.packets = 0
+        self.lost = 0  # packets that first arrived as a retransmission
+        self.retransmitted = 0
+        self.duplicates = 0
+        self.parity = 0  # parity packets received
+        self.recovered = 0  # packets repaired from parity instead of resent
+        self.resumes = 0  # streams continued with resume after an outage
+        self.station_ttfb = []  # join_station until the first audio packet
+        self.station_packets = 0
+        self.station_bytes = 0
+        self.station_lost = 0  # gaps in the sequence numbers of a station song
+
+    def record(self, command, seconds):
+        self.latencies.setdefault(command, []).append(seconds)
+
+    def fail(self, command, reason):
+        self.errors[command] = self.errors.get(command, 0) + 1
+        print(f"{command} failed: {reason}", file=sys.stderr)
+
+
+async def command(client, results, name, messages, replies=1):  # Send a command, time its replies
+    while not client.queue.empty():
+        client.queue.get_nowait()  # late replies to an earlier command
+    started = time.perf_counter()
+    client.send(*messages)
+    answers = []
+    try:
+        for _ in range(replies):
+            _, data = await client.receive(REPLY_TIMEOUT)
+            answers.append(data.decode(errors="replace"))
+    except asyncio.TimeoutError:
+        results.fail(name, "timed out")
+        return None
+    results.record(name, time.perf_counter() - started)
+    return answers
+
+
+async def stream(client, results, song_path, fec=0, outage=0):  # Receive a whole song the way the client does, nacking losses
+    started = time.perf_counter()
+    if fec:
+        client.send(f"fec {fec}")
+    client.send("stream_song", song_path)
+    stream_id = total = first = token = None
+    resumed = False  # a resume was sent and its stream hasn't started yet
+    received = set()
+    contiguous, highest, unacked = 0, -1, 0
+    fec_group, parities, recovered = 0, set(), 0  # parity payloads aren't kept, the client tests the xor itself
+    window = max(8, client.transport.get_extra_info("socket").getsockopt(
+        socket.SOL_SOCKET, socket.SO_RCVBUF) * 3 // 4 // RECEIVE_PACKET_COST)
+    ended = False
+    last_data = last_nack = last_resume = started
+
+    def try_recover(group):  # A group missing one packet whose parity arrived counts as repaired
+        nonlocal recovered
+        if group not in parities or total is None:
+            return
+        missing = [seq for seq in range(group, min(group + fec_group, total)) if seq not in received]
+        if len(missing) > 1:
+            return
+        parities.discard(group)
+        if missing:
+            received.add(missing[0])
+            recovered += 1
+            results.recovered += 1
+
+    while total is None or len(received) < total:
+        try:
+            arrived, data = await client.receive(NACK_INTERVAL)
+        except asyncio.TimeoutError:
+            now = time.perf_counter()
+            if token is not None and now - last_data > RESUME_AFTER:
+                if now - last_data > RESUME_TIMEOUT:
+                    results.fail("resume", f"stalled after {len(received)} packets")
+                    return
+                if now - last_resume > RESUME_INTERVAL:
+                    client.send(f"resume {token} {contiguous}")
+                    last_resume, resumed = now, True
+                continue
+            if now - last_data > STREAM_TIMEOUT:
+                results.fail("stream_song", f"stalled after {len(received)} packets")
+                return
+            ended = True  # the tail may have been lost, ask for it
+            arrived, data = None, None
+            if stream_id is not None:
+                client.send(f"ack {stream_id} {contiguous} {highest} {window} {recovered}")
+
+        if data is not None and data[:2] == PACKET_MAGIC and len(data) >= PACKET_HEADER.size:
+            _, _, flags, packet_stream, seq = PACKET_HEADER.unpack_from(data)
+            if packet_stream != stream_id:
+                continue  # not ours, or ours before its start_streaming
+            last_data = arrived
+            first = first or arrived
+            if flags & FLAG_PARITY:
+                results.parity += 1
+                if fec_group:
+                    parities.add(seq)
+                    try_recover(seq)
+            else:
+                if flags & FLAG_RETRANSMIT:
+                    results.retransmitted += 1
+                if flags & FLAG_LAST:
+                    total = seq + 1
+                if seq in received:
+                    results.duplicates += 1
+                    continue
+                received.add(seq)
+                highest = max(highest, seq)
+                results.packets += 1
+                results.stream_bytes += len(data) - PACKET_HEADER.size
+                if flags & FLAG_RETRANSMIT:
+                    results.lost += 1
+                if fec_group:
+                    try_recover(seq - seq % fec_group)
+            while contiguous in received:
+                contiguous += 1
+            if outage and total is not None and contiguous >= total // 2:
+                client.offline_until = time.perf_counter() + outage  # half way through, the network drops
+                outage = 0
+            unacked += 1
+            if unacked >= ACK_EVERY:
+                client.send(f"ack {stream_id} {contiguous} {highest} {window} {recovered}")
+                unacked = 0
+        elif data is not None:
+            parts = data.decode(errors="replace").split(" ")
+            if parts[0] == "start_streaming" and len(parts) >= 3:
+                stream_id, total = int(parts[1]), int(parts[2])
+                if len(parts) >= 7:
+                    fec_group = int(parts[6])
+                if len(parts) >= 8 and parts[7] != "-":
+                    token = parts[7]
+                if resumed:
+                    results.record("resume", arrived - last_resume)
+                    results.resumes += 1
+                    resumed = False
+            elif parts[0] == "end_streaming" and len(parts) == 3 and int(parts[1]) == stream_id:
+                total, ended = int(parts[2]), True
+            elif parts[0] == "error:":
+                results.fail("stream_song", " ".join(parts[1:]))
+                return
+
+        now = time.perf_counter()
+        if ended and stream_id is not None and total is not None and now - last_nack > NACK_INTERVAL:
+            missing = [seq for seq in range(total) if seq not in received]
+            if missing:
+                client.send(f"nack {stream_id} {format_ranges(missing)}")
+            last_nack = now
+
+    client.send(f"stream_done {stream_id}")
+    results.ttfb.append(first - started)
+    results.completion.append(time.perf_counter() - started)
+
+
+def group_socket(group):  # Socket that is a member of the station's multicast group, on loopback
+    address, _, port = group.rpartition(":")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # every simulated listener binds the group port
+    sock.bind(("", int(port)))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(address) + socket.inet_aton("127.0.0.1"))
+    return sock
+
+
+async def station(client, results, seconds, loss):  # Listen to the radio for a while, counting what arrives and what doesn't
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    client.send("join_station")
+    receiver = client  # the group's socket with multicast
+    group_transport = None
+    stream_id, last_seq, first = None, -1, None
+    joined = False
+    try:
+        while time.perf_counter() - started < seconds:
+            try:
+                arrived, data = await receiver.receive(1)
+            except asyncio.TimeoutError:
+                if not joined:
+                    client.send("join_station")  # the join or its reply was lost, the client asks again too
+                continue
+            if data[:2] == PACKET_MAGIC and len(data) >= PACKET_HEADER.size:
+                _, _, _, packet_stream, seq = PACKET_HEADER.unpack_from(data)
+                if first is None:
+                    first = arrived
+                    results.station_ttfb.append(first - started)
+                if packet_stream != stream_id:
+                    stream_id, last_seq = packet_stream, seq - 1
+                elif seq <= last_seq:
+                    continue
+                results.station_lost += seq - last_seq - 1
+                last_seq = seq
+                results.station_packets += 1
+                results.station_bytes += len(data) - PACKET_HEADER.size
+                continue
+            parts = data.decode(errors="replace").split(" ")
+            if parts[0] == "station_joined" and len(parts) == 2:
+                if joined:
+                    continue
+                joined = True
+                results.record("join_station", arrived - started)
+                if parts[1] != "-" and group_transport is None:
+                    group_transport, receiver = await loop.create_datagram_endpoint(
+                        lambda: BenchClient(loss), sock=group_socket(parts[1]))
+            elif parts[0] == "error:":
+                results.fail("join_station", " ".join(parts[1:]))
+                return
+        if first is None:
+            results.fail("join_station", "no audio")
+    finally:
+        client.send("leave_station")
+        if group_transport is not None:
+            group_transport.close()
+
+
+async def listener(index, args, address, results):  # One client session: song, get_length, search, login, stream_song or the station
+    await asyncio.sleep(args.ramp * index / max(1, args.clients))
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(lambda: BenchClient(args.loss), remote_addr=address)
+    try:
+        answers = await command(client, results, "song", ["song"], replies=2)
+        if answers is None:
+            return
+        paths = ast.literal_eval(answers[0])
+        song_path = paths[0 if args.hot else index % len(paths)]
+
+        await command(client, results, "get_length", ["get_length", song_path])
+        title = os.path.splitext(os.path.basename(song_path))[0]
+        await command(client, results, "search", [f"search {index} 0 5 {title[:-1]}"])  # a title half typed, one fragment
+        answers = await command(client, results, "login", ["login", BENCH_USER[0], BENCH_USER[2]])
+        if answers is not None and answers[0] != "confirmed":
+            results.fail("login", answers[0])
+        if args.station:
+            await station(client, results, args.station, args.loss)
+            return
+        for _ in range(args.streams):
+            await stream(client, results, song_path, args.fec, args.outage)
+    finally:
+        transport.close()
+
+
+def start_server(env, workdir, log_name):  # Launch server.py, return the process and when it was launched
+    launched = time.perf_counter()
+    with open(os.path.join(workdir, log_name), 'w') as log:
+        process = subprocess.Popen([sys.executable, "-u", SERVER_SCRIPT], cwd=workdir, env=env, stdout=log,
+                                   stderr=subprocess.STDOUT)
+    return process, launched
+
+
+def stop_server(process):
+    process.terminate()
+    process.wait()
+
+
+async def wait_for_server(address, process, launched, log_path, workers, songs):  # Seconds until it answers, and until every song is listed
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(BenchClient, remote_addr=address)
+    answered = None
+    try:
+        while time.perf_counter() - launched < STARTUP_TIMEOUT:
+            if process.poll() is not None:
+                raise RuntimeError("server exited during startup, see its log")
+            if listening(log_path) < workers:
+                await asyncio.sleep(0.01)  # clients would move between workers as late ones join
+                continue
+            client.send("list_songs 1 0 1")
+            try:
+                _, data = await client.receive(0.05)
+            except asyncio.TimeoutError:
+                continue
+            answered = answered or time.perf_counter() - launched
+            header, _, body = data.partition(b"\n")
+            if header.startswith(b"page ") and json.loads(body)["total"] >= songs:
+                return answered, time.perf_counter() - launched
+            await asyncio.sleep(0.01)  # still indexing the music folder
+        raise TimeoutError("server did not start")
+    finally:
+        transport.close()
+
+
+async def register(address, sink):  # Create the benchmark account through register and verify_otp
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(BenchClient, remote_addr=address)
+    try:
+        name, email, pswd = BENCH_USER
+        client.send("register", name, email, pswd)
+        otp = await sink.wait_for_otp(email, REPLY_TIMEOUT)
+        client.send("verify_otp", otp)
+        _, data = await client.receive(REPLY_TIMEOUT)
+        if data != b"confirmed":
+            raise RuntimeError(f"registration failed: {data.decode(errors='replace')}")
+    finally:
+        transport.close()
+
+
+async def server_stats(address):  # Metrics of the server, or of the worker that answers, None if it won't answer
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(BenchClient, remote_addr=address)
+    try:
+        client.send("stats 1")
+        fragments = {}
+        count = None
+        while count is None or len(fragments) < count:
+            _, data = await client.receive(REPLY_TIMEOUT)
+            header, _, body = data.partition(b"\n")
+            parts = header.decode(errors="replace").split(" ")
+            if len(parts) == 4 and parts[0] == "stats":
+                fragments[int(parts[2])] = body
+                count = int(parts[3])
+        return json.loads(b"".join(fragments[index] for index in range(count)))
+    except (asyncio.TimeoutError, ValueError):
+        return None
+    finally:
+        transport.close()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(SERVER_SCRIPT)).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="musicstream-bench-")  # user store and catalog snapshot live here
+    music = os.path.join(workdir, "music")
+    make_library(music, args.songs, args.seconds)
+
+    sink = SmtpSink()
+    smtp_port = await sink.start()
+    port = free_port()
+    env = dict(os.environ, SERVER_PORT=str(port), MUSIC_FOLDER=music, SMTP_HOST="127.0.0.1",
+               SMTP_PORT=str(smtp_port), SMTP_STARTTLS="0", EMAIL=BENCH_USER[1], EMAIL_PWD="")
+    if args.bcrypt_rounds:
+        env["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    if args.group:
+        env["STATION_GROUP"] = args.group
+    workers = args.workers or os.cpu_count() or 1
+    env["SERVER_WORKERS"] = str(workers)
+    address = ("127.0.0.1", port)
+    process, launched = start_server(env, workdir, "server.log")
+    try:
+        startup, catalog_ready = await wait_for_server(address, process, launched,
+                                                       os.path.join(workdir, "server.log"), workers, args.songs)
+        await register(address, sink)
+
+        results = Results()
+        cpu_before = process_cpu(process.pid)
+        drops_before = udp_receive_drops()
+        own_cpu_before = time.process_time()
+        started = time.perf_counter()
+        await asyncio.gather(*(listener(index, args, address, results) for index in range(args.clients)))
+        wall = time.perf_counter() - started
+        cpu_after = process_cpu(process.pid)
+        drops_after = udp_receive_drops()
+        stats = await server_stats(address)
+        stop_server(process)
+
+        # restart on the catalog snapshot the first run saved, as after a deploy
+        process, launched = start_server(env, workdir, "server-restart.log")
+        restart, restart_ready = await wait_for_server(address, process, launched,
+                                                       os.path.join(workdir, "server-restart.log"), workers, args.songs)
+    finally:
+        stop_server(process)
+        await sink.close()
+
+    server_cpu = None if cpu_before is None or cpu_after is None else round(cpu_after - cpu_before, 3)
+    sent = results.packets + results.duplicates + results.parity
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": {"clients": args.clients, "songs": args.songs, "seconds": args.seconds,
+                   "streams": args.streams, "ramp": args.ramp, "hot": args.hot, "fec": args.fec, "loss": args.loss,
+                   "workers": workers, "station": args.station, "group": args.group,
+                   "outage": args.outage},
+        "startup_seconds": round(startup, 3),  # launch to first reply, first start without a catalog snapshot
+        "catalog_ready_seconds": round(catalog_ready, 3),  # launch until every song is listed
+        "restart_seconds": round(restart, 3),  # the same with the catalog snapshot of the first run
+        "restart_ready_seconds": round(restart_ready, 3),
+        "wall_seconds": round(wall, 3),
+        "commands": {name: dict(percentiles(values), errors=results.errors.get(name, 0))
+                     for name, values in results.latencies.items()},
+        "errors": results.errors,
+        "streams": {
+            "completed": len(results.completion),
+            "ttfb_ms": percentiles(results.ttfb),
+            "completion_ms": percentiles(results.completion),
+            "bytes": results.stream_bytes,
+            "throughput_mbps": round(results.stream_bytes * 8 / wall / 1e6, 3),
+            "packets": results.packets,
+            "lost": results.lost,
+            "loss_ratio": round(results.lost / results.packets, 5) if results.packets else None,
+            "retransmitted": results.retransmitted,
+            "duplicates": results.duplicates,
+            "parity": results.parity,
+            "recovered": results.recovered,
+            "resumes": results.resumes,
+            "datagrams": sent,
+            "udp_receive_drops": None if drops_before is None or drops_after is None else drops_after - drops_before,
+        },
+        "station": {
+            "listeners": len(results.station_ttfb),
+            "ttfb_ms": percentiles(results.station_ttfb),
+            "packets": results.station_packets,
+            "bytes": results.station_bytes,
+            "lost": results.station_lost,
+            "loss_ratio": (round(results.station_lost / (results.station_packets + results.station_lost), 5)
+                           if results.station_packets else None),
+        },
+        "cpu": {
+            "server_seconds": server_cpu,
+            "server_percent": round(100 * server_cpu / wall, 1) if server_cpu is not None else None,
+            "benchmark_seconds": round(time.process_time() - own_cpu_before, 3),
+        },
+        "server_stats": stats,
+        "workdir": workdir,
+    }
+
+
+def headline(report):  # Numbers worth comparing between commits, missing ones are None in older reports
+    streams = report.get("streams", {})
+    numbers = {
+        "startup_seconds": report.get("startup_seconds"),
+        "restart_seconds": report.get("restart_seconds"),
+        "catalog_ready_seconds": report.get("catalog_ready_seconds"),
+        "throughput_mbps": streams.get("throughput_mbps"),
+        "ttfb_p50_ms": (streams.get("ttfb_ms") or {}).get("p50"),
+        "ttfb_p99_ms": (streams.get("ttfb_ms") or {}).get("p99"),
+        "completion_p99_ms": (streams.get("completion_ms") or {}).get("p99"),
+        "loss_ratio": streams.get("loss_ratio"),
+        "recovered": streams.get("recovered"),
+        "resumes": streams.get("resumes"),
+        "duplicates": streams.get("duplicates"),
+        "udp_receive_drops": streams.get("udp_receive_drops"),
+        "station_ttfb_p99_ms": ((report.get("station") or {}).get("ttfb_ms") or {}).get("p99"),
+        "station_loss_ratio": (report.get("station") or {}).get("loss_ratio"),
+        "server_cpu_percent": report.get("cpu", {}).get("server_percent"),
+    }
+    for name, summary in report.get("commands", {}).items():
+        numbers[f"{name}_p99_ms"] = summary.get("p99")
+    return numbers
+
+
+def print_report(report, previous=None):
+    before = headline(previous) if previous else {}
+    print(f"commit {report['commit']}  {report['params']}")
+    for name, value in headline(report).items():
+        line = f"  {name:<22} {value}"
+        old = before.get(name)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            line += f"  ({(value - old) / old:+.1%} vs {previous['commit']})"
+        print(line)
+    if report["errors"]:
+        print(f"  errors {report['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test server.py on loopback")
+    parser.add_argument("--clients", type=int, default=10, help="simulated listeners")
+    parser.add_argument("--songs", type=int, default=20, help="songs in the generated library")
+    parser.add_argument("--seconds", type=float, default=20, help="length of each generated song")
+    parser.add_argument("--streams", type=int, default=1, help="songs each listener streams")
+    parser.add_argument("--ramp", type=float, default=1, help="seconds over which listeners join")
+    parser.add_argument("--hot", action="store_true", help="every listener streams the same song")
+    parser.add_argument("--fec", type=int, default=0, help="ask for a parity packet every this many packets")
+    parser.add_argument("--loss", type=float, default=0.0, help="share of stream packets the listeners drop")
+    parser.add_argument("--outage", type=float, default=0,
+                        help="seconds each listener is cut off half way through a song, it resumes the stream after")
+    parser.add_argument("--workers", type=int, default=1, help="server processes, 0 for one per core")
+    parser.add_argument("--station", type=float, default=0, help="listen to the radio this many seconds instead of streaming")
+    parser.add_argument("--group", help="multicast group for the radio, e.g. 239.255.77.1:5601, default sends to each listener")
+    parser.add_argument("--bcrypt-rounds", type=int, help="override BCRYPT_ROUNDS for the server")
+    parser.add_argument("--output", default="benchmark.json", help="where to write the results as json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+    print_report(report, previous)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
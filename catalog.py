@@ -0,0 +1,197 @@
+import os
+import json
+import threading
+from search_index import SearchIndex
+
+CATALOG_FILE = "catalog.json"  # snapshot of the index, so a restart doesn't re-parse every song
+REFRESH_INTERVAL = 30  # seconds between checks of the music folder for changes
+SNAPSHOT_FORMAT = 2  # bumped when tracks gain fields, older snapshots are re-read from the files
+
+
+class Track:  # One song of the music library
+    __slots__ = ("track_id", "path", "title", "size", "mtime", "length", "bitrate", "artist", "album")
+
+    def __init__(self, track_id, path, title, size, mtime, length, bitrate, artist="", album=""):
+        self.track_id = track_id  # stable number clients use instead of the path
+        self.path = path
+        self.title = title
+        self.size = size
+        self.mtime = mtime
+        self.length = length  # seconds
+        self.bitrate = bitrate  # bits per second
+        self.artist = artist  # from the ID3 tags, "" when the file has none
+        self.album = album
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def tag_text(tags, frame_id):  # First value of an ID3 text frame like "TPE1", "" when the file doesn't have it
+    frame = tags.get(frame_id) if tags is not None else None
+    return str(frame.text[0]) if frame is not None and frame.text else ""
+
+
+def read_track(track_id, path, size, mtime):  # Parse one mp3 file into a Track
+    from mutagen.mp3 import MP3  # imported on the first new song, a start from the snapshot never needs it
+    try:
+        audio = MP3(path)
+        length, bitrate = audio.info.length, audio.info.bitrate
+        artist, album = tag_text(audio.tags, "TPE1"), tag_text(audio.tags, "TALB")
+    except Exception as e:
+        print(f"Error reading {path}: {e}")
+        length, bitrate = 0, 0
+        artist, album = "", ""
+    title = os.path.splitext(os.path.basename(path))[0]
+    return Track(track_id, path, title, size, mtime, length, bitrate, artist, album)
+
+
+def listing_row(track):  # What clients are told about a song in pages and search results
+    return (track.track_id, track.title, round(track.length, 2), track.size, int(track.mtime))
+
+
+class Catalog:  # In-memory index of the music folder, refreshed by file mtime
+    def __init__(self, folder, snapshot_path=CATALOG_FILE):
+        self.folder = folder
+        self.snapshot_path = snapshot_path
+        self.tracks = {}  # path -> Track
+        self.by_id = {}  # track_id -> Track
+        self.ordered = []  # tracks sorted by file name, as listed to clients
+        self.next_id = 1  # ids are never reused, so a client's id can't point at another song
+        self.version = 0  # bumped whenever the listing changes
+        self.folder_mtime = None  # mtime of the folder at the last full scan
+        self.snapshot_mtime = None  # mtime of the snapshot last loaded or saved
+        self.search = SearchIndex()  # words of titles, artists and albums
+        self.search_version = 0  # listing version the search index was last synced with
+        self.song_reply = (str([]), str(["No music files found"]))  # prebuilt answer to the song command
+        self.lock = threading.Lock()  # refreshes run in a worker thread
+
+    def get(self, path):
+        return self.tracks.get(path)
+
+    def resolve(self, ref):  # Track from an id like "42", or from a path for older clients
+        if ref.isdigit():
+            return self.by_id.get(int(ref))
+        return self.tracks.get(ref)
+
+    def page(self, offset, limit):  # [(id, title, length, size, mtime), ...] starting at offset in listing order
+        return [listing_row(track) for track in self.ordered[offset:offset + limit]]
+
+    def find(self, query, offset, limit):  # Rows of the songs matching query, best first, and whether more follow
+        track_ids, more = self.search.search(query, offset, limit)
+        by_id = self.by_id
+        return [listing_row(by_id[track_id]) for track_id in track_ids if track_id in by_id], more
+
+    def update_search(self):  # Bring the search index up to the listing, only new, changed and removed songs cost anything
+        version = self.version
+        if version != self.search_version:
+            self.search.sync(self.by_id)
+            self.search_version = version
+
+    def load(self):  # Start from the saved snapshot, if there is one
+        if not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            snapshot_mtime = os.stat(self.snapshot_path).st_mtime
+            with open(self.snapshot_path, 'r') as file:
+                snapshot = json.load(file)
+            if snapshot.get("folder") != self.folder:
+                return False  # snapshot of another music folder
+            if snapshot.get("format") != SNAPSHOT_FORMAT:
+                return False  # written before tracks had their current fields
+            tracks = {obj["path"]: Track(**obj) for obj in snapshot["tracks"]}
+            self.next_id = snapshot["next_id"]
+        except Exception as e:
+            print(f"Ignoring catalog snapshot: {e}")
+            return False
+        self.snapshot_mtime = snapshot_mtime
+        self.publish(tracks)
+        return True
+
+    def reload(self):  # Pick up a snapshot another worker saved, return True if it changed
+        with self.lock:
+            try:
+                if os.stat(self.snapshot_path).st_mtime == self.snapshot_mtime:
+                    return False
+            except FileNotFoundError:
+                return False
+            return self.load()
+
+    def save(self):
+        snapshot = {"format": SNAPSHOT_FORMAT, "folder": self.folder, "next_id": self.next_id,
+                    "tracks": [track.to_dict() for track in self.ordered]}
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(snapshot, file)
+        os.replace(temp_path, self.snapshot_path)  # never leave a half-written snapshot
+        self.snapshot_mtime = os.stat(self.snapshot_path).st_mtime
+
+    def refresh(self, force=False):  # Re-read only new or changed files, return True if anything changed
+        with self.lock:
+            if not os.path.isdir(self.folder): #check if music folder exists
+                print("Error", f"Folder not found: {self.folder}")
+                changed = bool(self.tracks)
+                if changed:
+                    self.publish({})
+                return changed
+
+            folder_mtime = os.stat(self.folder).st_mtime
+            if not force and folder_mtime == self.folder_mtime:
+                changed = self.refresh_known()  # no files added or removed, only check edits in place
+            else:
+                changed = self.rescan()
+                self.folder_mtime = folder_mtime
+
+            if changed:
+                self.save()
+            return changed
+
+    def rescan(self):  # List the folder and merge it with the current index
+        tracks = {}
+        changed = False
+        with os.scandir(self.folder) as entries:
+            for entry in entries:  #loop through files in directory
+                if not entry.name.endswith('.mp3') or not entry.is_file(): #check if file is MP3
+                    continue
+                path = os.path.join(self.folder, entry.name)
+                stat = entry.stat()
+                track = self.tracks.get(path)
+                if track is None:
+                    track = read_track(self.next_id, path, stat.st_size, stat.st_mtime)
+                    self.next_id += 1
+                    changed = True
+                elif track.size != stat.st_size or track.mtime != stat.st_mtime:
+                    track = read_track(track.track_id, path, stat.st_size, stat.st_mtime)  # edited song keeps its id
+                    changed = True
+                tracks[path] = track
+
+        if changed or len(tracks) != len(self.tracks):
+            self.publish(tracks)
+            return True
+        return False
+
+    def refresh_known(self):  # Stat the indexed files and re-read the ones that were modified
+        tracks = dict(self.tracks)
+        changed = False
+        for path, track in self.tracks.items():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del tracks[path]
+                changed = True
+                continue
+            if track.size != stat.st_size or track.mtime != stat.st_mtime:
+                tracks[path] = read_track(track.track_id, path, stat.st_size, stat.st_mtime)
+                changed = True
+        if changed:
+            self.publish(tracks)
+        return changed
+
+    def publish(self, tracks):  # Swap in a new index, readers on the loop thread see old or new, never half
+        ordered = sorted(tracks.values(), key=lambda track: os.path.basename(track.path))
+        music_files = [track.path for track in ordered]
+        music_titles = [track.title for track in ordered] or ["No music files found"]
+        self.tracks = tracks
+        self.by_id = {track.track_id: track for track in ordered}
+        self.ordered = ordered
+        self.song_reply = (str(music_files), str(music_titles))
+        self.version += 1
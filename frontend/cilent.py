@@ -1,4 +1,11 @@
 import socket  
+import os
+import shutil
+import struct  # For parsing stream packet headers
+import json  # For song list pages
+import itertools
+import queue  # Replies handed from the network thread to the UI thread
+from collections import deque
 import tkinter as tk  # For GUI components
 from tkinter import messagebox, ttk, font  
 import time 
@@ -10,14 +17,830 @@ SERVER_IP = "localhost"
 SERVER_PORT = 5000  
 BUFFER_SIZE = 1024 
 
-client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Create UDP socket
+# Stream packet header, must match PACKET_HEADER in streaming.py on the server
+PACKET_HEADER = struct.Struct("!2sBBII")  # magic, version, flags, stream id, sequence number
+PACKET_MAGIC = b"MS"
+PACKET_VERSION = 1
+FLAG_LAST = 0x02  # packet carries the final chunk of the song
+FLAG_PARITY = 0x04  # packet is the XOR of a group of chunks, its sequence number is the group's first
+PARITY_LENGTH = struct.Struct("!H")  # XOR of the chunk lengths, in front of a parity payload
+CHUNK_SIZE = 4096  # audio bytes per packet
+NACK_INTERVAL = 0.3  # seconds between requests for missing packets
+REORDER_TOLERANCE = 32  # packets a gap may trail the newest packet before it counts as lost
+MAX_NACK_LENGTH = 900  # keep nack datagrams well below BUFFER_SIZE
+ACK_EVERY = 8  # packets between acks, the server paces the stream by them
+ACK_INTERVAL = 0.1  # seconds between acks when packets arrive slowly
+RECEIVE_PACKET_COST = 2 * CHUNK_SIZE + 1024  # socket buffer memory one queued packet takes, bookkeeping included
+MIN_RECEIVE_WINDOW = 8  # packets advertised even on a tiny socket buffer
+RECEIVE_BUFFER_BYTES = 4 * 1024 * 1024  # SO_RCVBUF asked for, Linux caps it at net.core.rmem_max
+RECEIVE_PACKET_BYTES = 8192  # largest datagram read, a chunk plus its header fits
+WRITE_BATCH = 16  # chunks written to the file before playback is told about them
+WRITE_DELAY = 0.01  # seconds a partial batch waits for more packets before it is flushed anyway
+STREAM_TIMEOUT = 10  # seconds without a packet before a stream the server can't resume is given up
+RESUME_AFTER = 3  # seconds without a packet before the server is asked to continue where the stream stopped
+RESUME_INTERVAL = 1  # seconds between resume requests while the network is away
+RESUME_TIMEOUT = 60  # seconds without a packet before a resumable stream is given up
+CHECKPOINT_INTERVAL = 1  # seconds between notes of how far a download got, a restarted client resumes from there
+RESUME_KEEP = 300  # seconds an interrupted download is kept for a resume, the server forgets the stream after that
+STATION_BUFFER_SECONDS = 1.5  # live audio gathered before the radio starts playing
+STATION_RENEW = 20  # seconds between joins that keep the radio subscription alive
+STATION_TIMEOUT = 10  # seconds without a packet before the radio counts as lost
+STATION_RING_BYTES = 8 * 1024 * 1024  # size of the radio file, audio past it is written over the oldest from the start
+FEC_GROUP = 0  # chunks per parity packet, e.g. 8 repairs one loss in 8 without a resend for 1/8 more traffic, 0 is off
 
-def send_message(message):  # Helper function to send messages to server
-    client_socket.sendto(message.encode(), (SERVER_IP, SERVER_PORT))
+STREAMING_PLAYBACK = True  # start playing while the song is still arriving
+BUFFER_THRESHOLD_SECONDS = 3.0  # audio buffered before playback starts
+DEFAULT_BITRATE = 320000  # bits per second assumed when the server doesn't say
+UNDERRUN_WAIT = 15  # seconds playback waits for missing audio before giving up
+PROBE_DISTANCE = 64 * 1024  # reads starting this far past the arrived audio are tag probes, not playback
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".musicstream_cache")  # finished downloads
+CACHE_BUDGET = 500 * 1024 * 1024  # bytes of songs kept on disk
+
+PREFETCH_COUNT = 2  # songs after the current one downloaded in the background
+PREFETCH_SHARE = 2.0  # prefetch speed as a multiple of the song's bitrate
+PREFETCH_BUDGET = CACHE_BUDGET // 5  # bytes of upcoming songs fetched ahead at most
+GAPLESS = True  # queue a cached next song in the mixer so it starts without a gap
+
+LIST_PAGE_SIZE = 100  # songs fetched per list_songs request
+SEARCH_DELAY = 150  # milliseconds of no typing before the search box asks the server
+MAX_QUERY = 200  # characters of the search box sent, a query has to fit one datagram
+REQUEST_TIMEOUT = 2  # seconds to wait for a reply before asking again
+REQUEST_RETRIES = 3
+LOGIN_TIMEOUT = 30  # seconds a login may wait, the server queues password checks under load and a resend would add one
+IO_TICK = 0.05  # seconds between checks for late replies
+UI_POLL_INTERVAL = 16  # milliseconds between deliveries of replies to the UI, about 60 per second
+LOGIN_REPLIES = ("confirmed", "failed", "busy")
+OTP_REPLIES = ("confirmed", "wrong", "failed")
+
+def open_socket():  # UDP socket with room to queue a burst of audio while the receiver is busy
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_BYTES)  # capped by net.core.rmem_max
+    except OSError:
+        pass  # keep the system default
+    return sock
+
+client_socket = open_socket()  # Create UDP socket, commands only, owned by ClientIO
+
+request_ids = itertools.count(1)  # matches fragmented replies to their request
+
+
+class Request:  # A command waiting for its reply
+    __slots__ = ("messages", "kind", "request_id", "accept", "callback", "retries", "timeout", "deadline", "fragments",
+                 "count")
+
+    def __init__(self, messages, kind, accept, callback, retries, timeout):
+        self.messages = messages  # datagrams of the command, "{request_id}" is filled into the first one of a kind request
+        self.kind = kind  # first word of a fragmented reply, None for a plain one
+        self.request_id = next(request_ids)
+        self.accept = accept  # tells a plain reply to this command from a late one to an earlier command
+        self.callback = callback  # called on the UI thread with the reply, or None after the last retry
+        self.retries = retries
+        self.timeout = timeout  # seconds to wait for the reply to each send
+        self.deadline = None
+        self.fragments = {}
+        self.count = None
+
+
+class ClientIO:  # Owns the command socket, its thread sends requests and routes every reply to the one waiting for it
+    def __init__(self, sock):
+        self.socket = sock
+        self.lock = threading.Lock()
+        self.by_id = {}  # request id -> Request, for fragmented replies that carry the id
+        self.plain = deque()  # Requests whose reply carries no id, sent one at a time so replies can't be mixed up
+        self.done = queue.Queue()  # (callback, reply) for the UI thread, see poll()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def send(self, *messages):  # Command without a reply
+        with self.lock:
+            for message in messages:
+                self.socket.sendto(message.encode(), (SERVER_IP, SERVER_PORT))
+
+    def request(self, messages, callback, kind=None, accept=None, retries=REQUEST_RETRIES, timeout=REQUEST_TIMEOUT):
+        request = Request(messages, kind, accept, callback, retries, timeout)
+        with self.lock:
+            if kind is not None:
+                self.by_id[request.request_id] = request
+                self.transmit(request)
+            else:
+                self.plain.append(request)
+                if len(self.plain) == 1:
+                    self.transmit(request)  # otherwise sent when the one before it is answered
+        return request
+
+    def transmit(self, request):  # Called with the lock held, a command's datagrams must not interleave with another's
+        request.fragments = {}
+        request.deadline = time.monotonic() + request.timeout  # set first, expire() must never see a request without one
+        messages = list(request.messages)
+        if request.kind is not None:  # only the placeholder is replaced, names, passwords and queries are sent as typed
+            messages[0] = messages[0].replace("{request_id}", str(request.request_id), 1)
+        for message in messages:
+            self.socket.sendto(message.encode(), (SERVER_IP, SERVER_PORT))
+
+    def finish(self, request, reply):  # Called with the lock held
+        if request.kind is not None:
+            self.by_id.pop(request.request_id, None)
+        else:
+            self.plain.popleft()
+            if self.plain:
+                self.transmit(self.plain[0])
+        self.deliver(request.callback, reply)
+
+    def deliver(self, callback, reply=None):  # Run callback(reply) on the UI thread, from any thread
+        self.done.put((callback, reply))
+
+    def run(self):
+        self.socket.settimeout(IO_TICK)
+        while True:
+            try:
+                data, _ = self.socket.recvfrom(BUFFER_SIZE)
+            except socket.timeout:
+                data = None
+            except OSError:
+                return  # socket closed on exit
+            with self.lock:
+                if data is not None:
+                    self.route(data)
+                self.expire()
+
+    def route(self, data):
+        header, newline, body = data.partition(b"\n")
+        parts = header.decode(errors="replace").split(" ") if newline else ()
+        if len(parts) == 4 and parts[1].isdigit():  # "<kind> <id> <index> <count>" fragment
+            request = self.by_id.get(int(parts[1]))
+            if request is None or request.kind != parts[0]:
+                return  # reply to a request that was already answered or given up
+            request.fragments[int(parts[2])] = body
+            request.count = int(parts[3])
+            if len(request.fragments) >= request.count:
+                self.finish(request, b"".join(request.fragments[index] for index in range(request.count)))
+            return
+        reply = data.decode(errors="replace")
+        if self.plain and (self.plain[0].accept is None or self.plain[0].accept(reply)):
+            self.finish(self.plain[0], reply)
+
+    def expire(self):  # Resend requests whose reply is late, give up after their retries
+        now = time.monotonic()
+        waiting = list(self.by_id.values())
+        if self.plain:
+            waiting.append(self.plain[0])  # the ones queued behind it haven't been sent yet
+        for request in waiting:
+            if request.deadline > now:
+                continue
+            if request.retries > 0:
+                request.retries -= 1
+                self.transmit(request)  # a fragment or the reply was lost, ask for all of it again
+            else:
+                self.finish(request, None)
+
+    def poll(self):  # Run the callbacks of answered requests, on the UI thread
+        while True:
+            try:
+                callback, reply = self.done.get_nowait()
+            except queue.Empty:
+                return
+            callback(reply)
+
+
+def is_number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+def format_ranges(seqs, open_from=None):  # [4, 5, 9, 10, 11] -> "4-5,9-11", cut to fit one datagram
+    parts = []
+    length = 0
+    start = prev = None
+    for seq in seqs + [None]:
+        if start is not None and (seq is None or seq != prev + 1):
+            part = str(start) if start == prev else f"{start}-{prev}"
+            if length + len(part) + 1 > MAX_NACK_LENGTH:
+                return ",".join(parts)  # the rest is asked for in the next round
+            parts.append(part)
+            length += len(part) + 1
+            start = None
+        if seq is not None and start is None:
+            start = seq
+        prev = seq
+    if open_from is not None:
+        parts.append(f"{open_from}-")  # everything from here on, the total is not known yet
+    return ",".join(parts)
+
+class JitterBuffer:  # Tracks how much of a song has arrived in order, so playback can start early
+    def __init__(self, filename, bitrate, threshold_seconds=BUFFER_THRESHOLD_SECONDS):
+        self.filename = filename  # temp file the chunks are written into
+        self.byte_rate = (bitrate or DEFAULT_BITRATE) / 8
+        self.threshold_seconds = threshold_seconds
+        self.condition = threading.Condition()
+        self.contiguous = 0  # chunks received without a gap from the start
+        self.pending = set()  # chunks received past a gap
+        self.total_chunks = None
+        self.size = None  # exact size in bytes, known once the last chunk arrives
+        self.done = False  # every chunk has arrived
+        self.closed = False  # stream failed or was replaced by another song
+        self.read_pos = 0  # byte offset playback has consumed
+        self.underruns = 0  # times playback caught up with the network
+        self.started_at = time.monotonic()
+        self.first_sound_at = None
+        self.start_time = 0.0  # song time of the first byte, non-zero after a seek
+        self.token = None  # server's name for the stream, to resume it after a drop
+        self.playing = False  # the mixer reads from this buffer, set on the UI thread
+        self.ring_bytes = None  # size of a file written round and round, None when it holds the whole song
+
+    def add(self, seq, last_chunk_size=None):  # Record that a chunk has been written to the file
+        with self.condition:
+            if last_chunk_size is not None:
+                self.size = seq * CHUNK_SIZE + last_chunk_size
+            if seq == self.contiguous:
+                self.contiguous += 1
+                while self.contiguous in self.pending:
+                    self.pending.remove(self.contiguous)
+                    self.contiguous += 1
+            elif seq > self.contiguous:
+                self.pending.add(seq)
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.done = True
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def available(self):  # Bytes from the start of the song that can be played
+        available = self.contiguous * CHUNK_SIZE
+        if self.size is not None:
+            available = min(available, self.size)
+        return available
+
+    def expected_size(self):
+        if self.size is not None:
+            return self.size
+        if self.total_chunks is not None:
+            return self.total_chunks * CHUNK_SIZE
+        return self.available()
+
+    def buffer_seconds(self):  # Audio buffered ahead of playback
+        return max(0, self.available() - self.read_pos) / self.byte_rate
+
+    def ready(self):
+        return self.done or self.buffer_seconds() >= self.threshold_seconds
+
+
+class LiveBuffer(JitterBuffer):  # Radio audio in arrival order, in a file of fixed size that wraps around while it plays
+    def __init__(self, filename, threshold_seconds=STATION_BUFFER_SECONDS, ring_bytes=STATION_RING_BYTES):
+        super().__init__(filename, None, threshold_seconds)
+        self.written = 0  # bytes appended so far, byte n is at n % ring_bytes in the file
+        self.ring_bytes = ring_bytes
+
+    def append(self, size):
+        with self.condition:
+            self.written += size
+            self.condition.notify_all()
+
+    def available(self):
+        return self.written
+
+
+class StreamReader:  # File-like view of a JitterBuffer, reads wait for audio that hasn't arrived yet
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.file = open(buffer.filename, 'rb')
+        self.pos = 0
+
+    def read(self, size=-1):
+        buffer = self.buffer
+        if size is None or size < 0:
+            size = buffer.expected_size() - self.pos
+        with buffer.condition:
+            if buffer.ring_bytes is not None:
+                self.pos = max(self.pos, buffer.available() - buffer.ring_bytes // 2)  # paused so long the audio was written over
+            if not buffer.done and self.pos - buffer.available() > PROBE_DISTANCE:
+                return b""  # decoder probing the end of the file for tags
+            if self.pos + size > buffer.available() and not buffer.done and not buffer.closed:
+                buffer.underruns += 1  # playback caught up with the network
+                deadline = time.monotonic() + UNDERRUN_WAIT
+                while self.pos + size > buffer.available() and not buffer.done and not buffer.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    buffer.condition.wait(remaining)
+            size = max(0, min(size, buffer.available() - self.pos))
+        if buffer.first_sound_at is None:
+            buffer.first_sound_at = time.monotonic()
+        if buffer.ring_bytes is None:
+            self.file.seek(self.pos)
+            data = self.file.read(size)
+        else:
+            start = self.pos % buffer.ring_bytes
+            self.file.seek(start)
+            data = self.file.read(min(size, buffer.ring_bytes - start))
+            if len(data) < size:
+                self.file.seek(0)
+                data += self.file.read(size - len(data))  # the rest wrapped around to the start
+        self.pos += len(data)
+        buffer.read_pos = max(buffer.read_pos, self.pos)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.buffer.expected_size()
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.file.close()
+
+
+class SongCache:  # Finished downloads on disk, least recently played evicted first
+    def __init__(self, directory=CACHE_DIR, budget=CACHE_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        self.lock = threading.Lock()  # stores happen on streaming threads
+        self.interrupted = {}  # key -> (partial, token, chunks) of downloads the last run didn't finish
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".part"):
+                partial = os.path.join(directory, name)
+                checkpoint = self.read_checkpoint(partial)
+                if checkpoint is not None:
+                    key, token, chunks = checkpoint
+                    self.interrupted[key] = (partial, token, chunks)
+                else:
+                    self.discard(partial)  # left over from a download that can't be resumed
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + ".mp3")
+
+    def lookup(self, key):  # Path of the cached song, or None
+        path = self.path_for(key)
+        try:
+            os.utime(path)  # file mtime doubles as the last time it was played
+        except OSError:
+            return None
+        return path
+
+    def new_partial(self):  # File a download is written into until it is complete
+        temp_file = tempfile.NamedTemporaryFile(dir=self.directory, suffix=".part", delete=False)
+        temp_file.close()
+        return temp_file.name
+
+    def checkpoint(self, partial, key, token, chunks):  # Note how far a download got, chunks are in the file without a gap
+        temp_path = partial + ".resume.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump({"key": key, "token": token, "chunks": chunks}, file)
+        os.replace(temp_path, partial + ".resume")
+
+    def read_checkpoint(self, partial):  # (key, token, chunks) noted for a partial download, None if it can't be resumed
+        try:
+            if time.time() - os.stat(partial + ".resume").st_mtime > RESUME_KEEP:
+                return None  # the server has forgotten the stream by now
+            with open(partial + ".resume") as file:
+                note = json.load(file)
+            return note["key"], note["token"], note["chunks"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def take_interrupted(self, key):  # (partial, token, chunks) of an unfinished download of key, or None
+        with self.lock:
+            return self.interrupted.pop(key, None)
+
+    def remove_checkpoint(self, partial):
+        try:
+            os.remove(partial + ".resume")
+        except OSError:
+            pass
+
+    def store(self, partial, key):  # Keep a finished download under its key
+        path = self.path_for(key)
+        self.remove_checkpoint(partial)
+        with self.lock:
+            try:
+                os.replace(partial, path)
+            except OSError:
+                shutil.copyfile(partial, path)  # partial still open for playback (Windows), copy it instead
+            self.evict(keep=path)
+        return path
+
+    def discard(self, partial):
+        self.remove_checkpoint(partial)
+        try:
+            os.remove(partial)
+        except OSError:
+            pass  # still open for playback, removed on a later start
+
+    def evict(self, keep=None):  # Remove least recently played songs until the cache fits its budget
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".mp3"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass  # playing right now
+
+
+def receive_window(sock):  # Packets the socket buffer can hold, the server keeps no more than this in flight
+    usable = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) * 3 // 4  # the kernel frees read space in batches
+    return max(MIN_RECEIVE_WINDOW, usable // RECEIVE_PACKET_COST)
+
+def receive_song(sock, filename, jitter_buffer, on_progress=None, resume=None):  # Receive one stream into filename, return an error or None
+    # resume: (token, chunks) of an interrupted download in filename, the server was asked to send what follows them
+    token, resume_from = resume or (None, 0)  # token names the stream when asking the server to resume it
+    stream_id = None  # id the server gave this stream
+    total_chunks = None  # known from start_streaming, end_streaming or the last packet
+    received = set(range(resume_from))  # sequence numbers written to the file
+    pending = []  # [(seq, length of a last chunk or None)] written but not flushed, playback can't see them yet
+    position = 0  # where the file is positioned, consecutive chunks are written without a seek
+    fec_group = 0  # chunks per parity packet, from start_streaming
+    parities = {}  # first sequence number of a group -> (length xor, parity payload)
+    recovered = 0  # chunks rebuilt from parity instead of resent
+    contiguous = resume_from  # packets received without a gap from the start
+    highest = resume_from - 1  # newest sequence number seen
+    ended = False  # server has sent everything once
+    last_data = time.monotonic()
+    last_resume = 0
+    last_nack = 0
+    last_ack = 0
+    unacked = 0  # packets received since the last ack
+    window = receive_window(sock)
+    buffer = bytearray(RECEIVE_PACKET_BYTES)  # every datagram is received into this, no allocation per packet
+    view = memoryview(buffer)
+
+    def send(message):
+        try:
+            sock.sendto(message.encode(), (SERVER_IP, SERVER_PORT))
+        except OSError:
+            pass  # no network right now, the stream is resumed once it is back
+
+    def send_ack():  # Tell the server how far we are, so it sends only what the socket can hold
+        nonlocal last_ack, unacked
+        if stream_id is not None:
+            send(f"ack {stream_id} {contiguous} {highest} {window} {recovered}")
+        last_ack = time.monotonic()
+        unacked = 0
+
+    def abandon():  # Nobody wants the song anymore, the server stops sending it
+        if stream_id is not None:
+            send(f"stream_done {stream_id}")
+
+    def request_missing(include_recent):  # Ask the server to resend lost packets
+        if stream_id is None:
+            return
+        if not include_recent:
+            limit = highest + 1 - REORDER_TOLERANCE  # newer gaps may still be reordering
+        elif total_chunks is not None:
+            limit = total_chunks
+        else:
+            limit = highest + 1
+        missing = [seq for seq in range(max(limit, 0)) if seq not in received]
+        open_from = highest + 1 if total_chunks is None and include_recent else None
+        if missing or open_from is not None:
+            send(f"nack {stream_id} {format_ranges(missing, open_from)}")
+
+    def store(seq, payload, last):  # Write a chunk where it belongs in the file, playback sees it after flush()
+        nonlocal contiguous, unacked, position
+        offset = seq * CHUNK_SIZE
+        if offset != position:
+            file.seek(offset)  # packets may arrive out of order
+        file.write(payload)
+        position = offset + len(payload)
+        received.add(seq)
+        pending.append((seq, len(payload) if last else None))
+        while contiguous in received:
+            contiguous += 1
+        unacked += 1
+        if len(pending) >= WRITE_BATCH:
+            flush()
+
+    def flush():  # Hand the written chunks to playback, the reader opens the same file
+        file.flush()
+        for seq, length in pending:
+            jitter_buffer.add(seq, length)
+        pending.clear()
+        if on_progress is not None:
+            on_progress()
+
+    def try_recover(first):  # Rebuild the one missing chunk of a group from its parity and the others
+        nonlocal recovered, position
+        if first not in parities or total_chunks is None:
+            return  # the group's size is only certain once the song length is known
+        group = range(first, min(first + fec_group, total_chunks))
+        missing = [seq for seq in group if seq not in received]
+        if len(missing) != 1:
+            if not missing:
+                del parities[first]
+            return  # nothing lost, or more than the parity can repair
+        length, value = parities.pop(first)
+        for seq in group:
+            if seq != missing[0]:
+                file.seek(seq * CHUNK_SIZE)
+                chunk = file.read(CHUNK_SIZE)
+                length ^= len(chunk)
+                value ^= int.from_bytes(chunk, "big") << (8 * (CHUNK_SIZE - len(chunk)))
+        position = -1  # moved by the reads
+        if not 0 < length <= CHUNK_SIZE:
+            return  # parity doesn't match what arrived
+        store(missing[0], value.to_bytes(CHUNK_SIZE, "big")[:length], missing[0] == total_chunks - 1)
+        recovered += 1
+
+    jitter_buffer.contiguous = resume_from
+    jitter_buffer.token = token
+    try:
+        # buffered like the batches, so a run of in-order chunks reaches the disk in one write
+        mode = 'r+b' if resume_from else 'w+b'  # read back too, for parity repairs
+        with open(filename, mode, buffering=WRITE_BATCH * CHUNK_SIZE) as file:
+            while True:
+                sock.settimeout(WRITE_DELAY if pending else NACK_INTERVAL)  # wake up to ask for lost packets
+                try:
+                    size = sock.recv_into(buffer)  # Receive data from server
+                except socket.timeout:
+                    if pending:
+                        flush()  # the stream paused, don't keep playback waiting for a full batch
+                        continue
+                    if jitter_buffer.closed:
+                        abandon()
+                        return None  # abandoned while the server was quiet
+                    silent = time.monotonic() - last_data
+                    if token is not None and silent > RESUME_AFTER:  # network dropped, or our address changed with it
+                        if silent > RESUME_TIMEOUT:
+                            return "Streaming timed out"
+                        if time.monotonic() - last_resume > RESUME_INTERVAL:
+                            send(f"resume {token} {contiguous}")  # only the chunks after the ones we have
+                            last_resume = time.monotonic()
+                        continue
+                    if silent > STREAM_TIMEOUT:
+                        return "Streaming timed out"
+                    send_ack()  # an earlier ack may have been lost and the server may be waiting for it
+                    request_missing(include_recent=True)  # the tail may have been lost
+                    continue
+                if jitter_buffer.closed:
+                    abandon()
+                    return None  # another song was selected, leave the socket to its receiver
+
+                if size >= PACKET_HEADER.size and buffer.startswith(PACKET_MAGIC):  # audio, control messages are text
+                    _, version, flags, packet_stream, seq = PACKET_HEADER.unpack_from(buffer)
+                    if version != PACKET_VERSION:
+                        continue  # a format this client doesn't know
+                    if packet_stream != stream_id:
+                        continue  # an earlier song, or ours before its start_streaming, resent once nacked
+                    last_data = time.monotonic()
+                    if flags & FLAG_PARITY:
+                        if fec_group and seq % fec_group == 0 and size >= PACKET_HEADER.size + PARITY_LENGTH.size:
+                            length, = PARITY_LENGTH.unpack_from(buffer, PACKET_HEADER.size)
+                            payload = view[PACKET_HEADER.size + PARITY_LENGTH.size:size]
+                            parities[seq] = (length, int.from_bytes(payload, "big"))
+                            try_recover(seq)
+                    else:
+                        if flags & FLAG_LAST:
+                            total_chunks = seq + 1
+                            jitter_buffer.total_chunks = total_chunks
+                        if seq not in received:
+                            store(seq, view[PACKET_HEADER.size:size], flags & FLAG_LAST)
+                            if fec_group:
+                                try_recover(seq - seq % fec_group)  # this may be the last chunk its parity waited for
+                        highest = max(highest, seq)
+                else:
+                    message = bytes(view[:size]).decode(errors="replace")  # Control message
+                    parts = message.split(" ")
+                    if parts[0] == "start_streaming" and len(parts) >= 3:
+                        stream_id = int(parts[1])
+                        total_chunks = int(parts[2])
+                        jitter_buffer.total_chunks = total_chunks
+                        if len(parts) >= 4:
+                            jitter_buffer.byte_rate = (int(parts[3]) or DEFAULT_BITRATE) / 8
+                        if len(parts) >= 6:
+                            jitter_buffer.start_time = float(parts[5])  # frame the server started at
+                        if len(parts) >= 7:
+                            fec_group = int(parts[6])
+                        if len(parts) >= 8 and parts[7] != "-":
+                            token = jitter_buffer.token = parts[7]
+                        last_data = time.monotonic()
+                        continue
+                    elif parts[0] == "end_streaming" and len(parts) == 3:
+                        if int(parts[1]) != stream_id:
+                            continue
+                        total_chunks = int(parts[2])
+                        jitter_buffer.total_chunks = total_chunks
+                        ended = True
+                    elif message.startswith("error:"):
+                        return message[6:]
+                    else:
+                        continue
+
+                if jitter_buffer.closed:
+                    abandon()
+                    return None  # another song was selected
+
+                if total_chunks is not None and len(received) >= total_chunks:
+                    flush()
+                    jitter_buffer.finish()
+                    send(f"stream_done {stream_id}")  # server can drop its send window
+                    return None
+
+                now = time.monotonic()
+                if unacked >= ACK_EVERY or (unacked and now - last_ack > ACK_INTERVAL):
+                    send_ack()
+                if ended and now - last_nack > NACK_INTERVAL:
+                    request_missing(include_recent=True)
+                    last_nack = now
+                elif now - last_nack > NACK_INTERVAL and highest - REORDER_TOLERANCE > 0:
+                    request_missing(include_recent=False)  # gaps well behind the newest packet
+                    last_nack = now
+    finally:
+        sock.settimeout(None)  # back to blocking for the other requests
+
+
+def local_address():  # Address of the interface that reaches the server, multicast is joined on it
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect((SERVER_IP, SERVER_PORT))  # picks a route, nothing is sent
+        return probe.getsockname()[0]
+    finally:
+        probe.close()
+
+
+def open_group_socket(group):  # Socket receiving the station's multicast group, "239.255.77.1:5001"
+    address, _, port = group.rpartition(":")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # other listeners on this machine share the port
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_BYTES)
+    sock.bind(("", int(port)))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    socket.inet_aton(address) + socket.inet_aton(local_address()))
+    return sock
+
+
+def receive_station(sock, filename, live_buffer, on_progress=None, on_song=None):  # Write the radio into filename until live_buffer is closed, return an error or None
+    listen = sock  # where audio arrives, the command socket or a multicast group socket
+    group_socket = None
+    joined = False
+    stream_id = None  # song on air from now_playing, every song of the station has its own id
+    last_seq = None  # None until the first packet of that song
+    lost = 0  # packets that never arrived, the decoder skips to the next packet's first frame
+    last_data = time.monotonic()
+    last_join = 0
+    buffer = bytearray(RECEIVE_PACKET_BYTES)
+    view = memoryview(buffer)
+
+    def join():
+        nonlocal last_join
+        sock.sendto(b"join_station", (SERVER_IP, SERVER_PORT))
+        last_join = time.monotonic()
+
+    try:
+        with open(filename, 'wb') as file:
+            join()
+            while not live_buffer.closed:
+                now = time.monotonic()
+                if now - last_data > STATION_TIMEOUT:
+                    return "Station timed out"
+                if group_socket is None and now - last_join > (STATION_RENEW if joined else NACK_INTERVAL * 3):
+                    join()  # renew the subscription, or ask again if the first join was lost
+                listen.settimeout(NACK_INTERVAL)
+                try:
+                    size = listen.recv_into(buffer)
+                except socket.timeout:
+                    continue
+
+                if size >= PACKET_HEADER.size and buffer.startswith(PACKET_MAGIC):
+                    _, version, _, packet_stream, seq = PACKET_HEADER.unpack_from(buffer)
+                    if version != PACKET_VERSION:
+                        continue
+                    if packet_stream != stream_id:
+                        continue  # a song stream of this socket still running out, or a song not announced yet
+                    if last_seq is None:
+                        last_seq = seq - 1  # first packet after joining or after a song change
+                    elif seq <= last_seq:
+                        continue  # late or duplicate, the audio after it has already been written
+                    lost += seq - last_seq - 1
+                    last_seq = seq
+                    last_data = time.monotonic()
+                    payload = view[PACKET_HEADER.size:size]  # packets hold whole frames, any one can come first
+                    offset = live_buffer.written % live_buffer.ring_bytes
+                    head = min(len(payload), live_buffer.ring_bytes - offset)
+                    file.seek(offset)
+                    file.write(payload[:head])
+                    if head < len(payload):
+                        file.seek(0)
+                        file.write(payload[head:])  # wrapped, over audio played long ago
+                    file.flush()
+                    live_buffer.append(size - PACKET_HEADER.size)
+                    if on_progress is not None:
+                        on_progress()
+                    continue
+
+                message = bytes(view[:size]).decode(errors="replace")
+                parts = message.split(" ", 6)
+                if parts[0] == "station_joined" and len(parts) == 2:
+                    joined = True
+                    last_data = time.monotonic()
+                    if parts[1] != "-" and group_socket is None:
+                        group_socket = listen = open_group_socket(parts[1])  # audio is multicast, not sent to us
+                elif parts[0] == "now_playing" and len(parts) == 7:
+                    if int(parts[1]) != stream_id:
+                        stream_id, last_seq = int(parts[1]), None  # next song, its packets follow
+                    live_buffer.byte_rate = (int(parts[5]) or DEFAULT_BITRATE) / 8
+                    if on_song is not None:
+                        on_song(parts[6], float(parts[3]), float(parts[4]))
+                elif message.startswith("error:"):
+                    return message[6:]
+        return None
+    finally:
+        if lost:
+            print(f"Radio lost {lost} packets")
+        sock.sendto(b"leave_station", (SERVER_IP, SERVER_PORT))
+        sock.settimeout(None)
+        if group_socket is not None:
+            group_socket.close()
+
+
+class Prefetcher:  # Downloads the songs after the current one into the cache, on its own socket
+    def __init__(self, cache, share=PREFETCH_SHARE, budget=PREFETCH_BUDGET):
+        self.cache = cache
+        self.share = share  # server sends prefetches at this multiple of the bitrate, without a burst
+        self.budget = budget  # bytes fetched ahead of playback at most
+        self.socket = open_socket()  # separate session, so playback isn't replaced
+        self.lock = threading.Lock()
+        self.wanted = []  # [(song id, cache key, size)] in play order
+        self.current = None  # (key, JitterBuffer) of the download in progress
+        self.wakeup = threading.Event()
+        self.fetched = 0  # songs completed, for tuning
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def schedule(self, songs):  # Replace the list of songs to fetch, in the order they will play
+        selected = []
+        total = 0
+        for song_id, key, size in songs:
+            if total + size > self.budget:
+                break  # keep prefetches from pushing songs that will be replayed out of the cache
+            total += size
+            selected.append((song_id, key, size))
+        with self.lock:
+            self.wanted = selected
+            if self.current is not None and self.current[0] not in [key for _, key, _ in selected]:
+                self.current[1].close()  # that song is no longer coming up
+        self.wakeup.set()
+
+    def next_song(self):
+        with self.lock:
+            for song_id, key, size in self.wanted:
+                if self.cache.lookup(key) is None:
+                    return song_id, key
+        return None
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while True:
+                song = self.next_song()
+                if song is None:
+                    break
+                song_id, key = song
+                partial = self.cache.new_partial()
+                jitter_buffer = JitterBuffer(partial, None)
+                with self.lock:
+                    self.current = (key, jitter_buffer)
+                self.socket.sendto("prefetch_song".encode(), (SERVER_IP, SERVER_PORT))
+                self.socket.sendto(song_id.encode(), (SERVER_IP, SERVER_PORT))
+                self.socket.sendto(f"{self.share:g}".encode(), (SERVER_IP, SERVER_PORT))
+                error = receive_song(self.socket, partial, jitter_buffer)
+                with self.lock:
+                    self.current = None
+                if jitter_buffer.done:
+                    self.cache.store(partial, key)
+                    self.fetched += 1
+                else:
+                    self.cache.discard(partial)
+                    if error is not None:
+                        print(f"Prefetch of song {song_id} failed: {error}")
+                        break  # try again on the next schedule
 
-def recieve_message():  # Helper function to receive messages from server (note typo in name)
-    response, _ = client_socket.recvfrom(BUFFER_SIZE)
-    return response.decode()
 
 class App:  # Main application class
     def __init__(self, root):  # Initialize the application
@@ -42,6 +865,22 @@ class App:  # Main application class
         self.password_var = tk.StringVar()  # Variable to store password
         self.otp_var = tk.StringVar()  # Variable to store OTP
 
+        self.io = ClientIO(client_socket)  # requests and replies, off the UI thread
+        self.stream_socket = open_socket()  # song streams and the radio
+        self.stream_thread = None  # thread reading stream_socket, the next one waits for it to let go
+        self.library_generation = 0  # bumped when the song list is reloaded, late pages of the old list are dropped
+        self.page_request = None  # list_songs request in flight
+        self.after_page = []  # callbacks waiting for that page
+        self.search_query = ""  # songs listed are the ones matching this, all of them when empty
+        self.search_timer = None  # pending search while the user is still typing
+
+        self.song_cache = SongCache()  # Songs already downloaded
+        self.partial_file = None  # Download of the current song that won't be cached (seek, failure)
+        self.prefetcher = Prefetcher(self.song_cache)  # Upcoming songs, fetched while this one plays
+        self.playing_file = False  # mixer plays a whole file, so a next song can be queued behind it
+        self.queued_index = None  # song queued in the mixer for a gapless start
+        self.on_air = False  # playing the station rather than a song of the list
+
         self.current_user = ""  # Track current logged-in user
         self.current_email = ""  # Track current user's email
         self.timer_id = None  # For managing timed events
@@ -55,6 +894,11 @@ class App:  # Main application class
         self.logo_label.pack()  # Display logo
         
         self.show_main_page()  # Show the main page initially
+        self.poll_network()
+
+    def poll_network(self):  # Deliver replies that arrived meanwhile, the window never waits for the network
+        self.io.poll()
+        self.root.after(UI_POLL_INTERVAL, self.poll_network)
 
     def create_styled_button(self, parent, text, command, primary=True, width=15):  # Helper to create styled buttons
         if primary:
@@ -170,21 +1014,18 @@ class App:  # Main application class
             loading_label.destroy()  # Remove loading message
             return
         
-        send_message("register")  # Send registration command to server
-        send_message(self.name_var.get())  # Send name to server
-        send_message(self.email_var.get())  # Send email to server
-        send_message(self.password_var.get())  # Send password to server
+        self.io.send("register", self.name_var.get(), self.email_var.get(), self.password_var.get())  # No reply, the otp comes by mail
         
         self.current_user = self.name_var.get()  # Store current user's name
         self.current_email = self.email_var.get()  # Store current user's email
         
         loading_label.config(text="OTP sent to your email")  # Update loading message
-        self.root.update()  # Force UI update
-        time.sleep(1)  # Wait briefly
-        loading_label.destroy()  # Remove loading message
-        
-        self.clear_labels()  # Clear any other labels
-        self.show_otp_page()  # Show OTP verification page
+
+        def show_otp():
+            loading_label.destroy()  # Remove loading message
+            self.clear_labels()  # Clear any other labels
+            self.show_otp_page()  # Show OTP verification page
+        self.root.after(1000, show_otp)  # Wait briefly
 
     def show_otp_page(self):  # Display OTP verification page
         self.clear_window()  # Remove previous content
@@ -226,18 +1067,24 @@ class App:  # Main application class
         loading_label.pack(pady=10)  # Display loading message
         self.root.update()  # Force UI update to show loading message
         
-        send_message(self.otp_var.get())  # Send OTP to server
-        response = recieve_message()  # Get verification result from server
-        
+        self.io.request(["verify_otp", self.otp_var.get()], lambda response: self.otp_verified(loading_label, response),
+                        accept=OTP_REPLIES.__contains__, retries=0)  # a resent otp would count as another guess
+
+    def otp_verified(self, loading_label, response):  # Verification result from server
         loading_label.destroy()  # Remove loading message
         
         if response == "confirmed":  # Check if OTP was valid
             success_label = tk.Label(self.root, text="Registration successful!", 
                                 font=self.normal_font, fg="green", bg=self.bg_color)  # Create success message
             success_label.pack(pady=10)  # Display success message
-            self.root.update()  # Force UI update
-            time.sleep(1.5)  # Brief delay to show success message
-            self.show_home_page()  # Navigate to home page after successful registration
+            self.root.after(1500, self.show_home_page)  # Navigate to home page after a brief look at the message
+        elif response is None:
+            messagebox.showerror("Error", "Server did not answer, please try again")  # Stay on the OTP page
+            return
+        elif response == "wrong":
+            messagebox.showerror("Error", "Wrong OTP, please try again")  # Attempts left, stay on the OTP page
+            self.otp_var.set("")
+            return
         else:
             messagebox.showerror("Error", "OTP verification failed")  # Show error for invalid OTP
             self.show_main_page()  # Return to main page on failure
@@ -296,23 +1143,24 @@ class App:  # Main application class
         loading_label.pack(pady=10)  # Display loading message
         self.root.update()  # Force UI update to show loading message
         
-        send_message("login")  # Send login command to server
-        send_message(self.name_var.get())  # Send username to server
-        send_message(self.password_var.get())  # Send password to server
+        self.io.request(["login", self.name_var.get(), self.password_var.get()],
+                        lambda response: self.logged_in(loading_label, response), accept=LOGIN_REPLIES.__contains__,
+                        retries=0, timeout=LOGIN_TIMEOUT)  # each resend would queue another password check
         
         self.current_user = self.name_var.get()  # Store current username
-        
-        response = recieve_message()  # Get login result from server
-        
+
+    def logged_in(self, loading_label, response):  # Login result from server
         loading_label.destroy()  # Remove loading message
         
         if response == "confirmed":  # Check if login was successful
             success_label = tk.Label(self.root, text="Login successful!", 
                                 font=self.normal_font, fg="green", bg=self.bg_color)  # Create success message
             success_label.pack(pady=10)  # Display success message
-            self.root.update()  # Force UI update
-            time.sleep(1)  # Brief delay to show success message
-            self.show_home_page()  # Navigate to home page after successful login
+            self.root.after(1000, self.show_home_page)  # Navigate to home page after a brief look at the message
+        elif response is None:
+            messagebox.showerror("Error", "Server did not answer, please try again")
+        elif response == "busy":
+            messagebox.showerror("Error", "Server is busy, please try again")  # Too many logins at once
         else:
             messagebox.showerror("Error", "Invalid username or password")  # Show error for invalid credentials
         
@@ -351,6 +1199,12 @@ class App:  # Main application class
         library_label = tk.Label(library_frame, text="Music Library", 
                                 font=self.normal_font, fg=self.secondary_color, bg=self.bg_color)  # Create library header
         library_label.pack(pady=10, anchor="w")  # Left-align library header
+
+        self.search_var = tk.StringVar()  # Text typed in the search box
+        self.search_var.trace_add("write", lambda *args: self.on_search_typed())
+        search_entry = self.create_styled_entry(library_frame, self.search_var)  # Search box, lists matches as you type
+        search_entry.pack(fill=tk.X, pady=(0, 10))
+        self.search_query = ""
         
         list_container = tk.Frame(library_frame, bg=self.bg_color)  # Create container for song list
         list_container.pack(fill=tk.BOTH, expand=True)  # Fill available space
@@ -366,7 +1220,8 @@ class App:  # Main application class
         self.song_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)  # Fill available space
         
         scrollbar.config(command=self.song_listbox.yview)  # Link scrollbar to song list
-        self.song_listbox.config(yscrollcommand=scrollbar.set)  # Link song list to scrollbar
+        self.song_scrollbar = scrollbar
+        self.song_listbox.config(yscrollcommand=self.on_list_scroll)  # Link song list to scrollbar, fetch pages on demand
         
         self.song_listbox.bind("<Double-1>", lambda event: self.set_selected_song())  # Bind double-click to play selected song
         
@@ -401,8 +1256,14 @@ class App:  # Main application class
         song_length_label.pack(side=tk.RIGHT)  # Position on right side
         
         self.progress_slider = ttk.Scale(player_frame, from_=0, to=100, 
-                                    orient=tk.HORIZONTAL, length=350)  # Slider for song progress (seek function commented out)
+                                    orient=tk.HORIZONTAL, length=350)  # Slider for song progress, releasing it seeks
         self.progress_slider.pack(fill=tk.X, padx=20)  # Make slider span width
+        self.progress_slider.bind("<ButtonRelease-1>", lambda event: self.seek_to_slider())  # Seek when the slider is released
+
+        self.buffer_status_var = tk.StringVar()  # Buffer level and underruns of the current stream
+        buffer_status_label = tk.Label(player_frame, textvariable=self.buffer_status_var,
+                                    font=self.small_font, fg=self.text_color, bg=self.bg_color)  # Display for buffer status
+        buffer_status_label.pack(pady=(5, 0))
         
         controls_frame = tk.Frame(player_frame, bg=self.bg_color)  # Create frame for playback controls
         controls_frame.pack(pady=20)  # Add padding
@@ -424,6 +1285,9 @@ class App:  # Main application class
                         bg=self.bg_color, fg=self.secondary_color, 
                         relief=tk.FLAT, command=self.play_next_song)  # Create next song button
         next_btn.pack(side=tk.LEFT, padx=10)  # Position on right
+
+        radio_btn = self.create_styled_button(player_frame, "📻 Radio", self.play_station, primary=False)  # Live station, shared by every listener
+        radio_btn.pack(pady=(0, 10))
         
         footer = tk.Label(self.root, text="© 2025 MusicStream", 
                         font=self.small_font, fg=self.secondary_color, bg=self.bg_color)  # Create copyright footer
@@ -440,22 +1304,99 @@ class App:  # Main application class
         self.show_main_page()  # Display the main page
 
     
-    def load_music_library(self):
-        send_message("song")  # Request song list from server
-        self.music_files = recieve_message()[2:-2].split(r"', '")  # Parse file paths
-        self.music_titles = recieve_message()[2:-2].split(r"', '")  # Parse song titles
-
+    def load_music_library(self):  # List the whole library, or the songs matching the search box
+        self.music_ids = []  # Server track ids, in listbox order
+        self.music_titles = []  # Song titles, in listbox order
+        self.music_keys = []  # Cache keys, change when the file changes on the server
+        self.music_sizes = []  # File sizes, to keep prefetching within its budget
+        self.music_lengths = []  # Song lengths, shown when the mixer moves on to a queued song
+        self.next_cursor = "0"  # Where the next page starts, None once everything is loaded
+        self.library_generation += 1
+        self.page_request = None
+        self.after_page = []
         self.song_listbox.delete(0, tk.END)  # Clear the song list display
-        for title in self.music_titles:
+        self.load_more_songs()
+
+    def load_more_songs(self, then=None):  # Ask for the next page of the song list, then() runs once it is shown
+        if self.next_cursor is None:
+            if then is not None:
+                then()
+            return
+        if then is not None:
+            self.after_page.append(then)
+        if self.page_request is not None:
+            return  # already on its way
+        generation = self.library_generation
+        if self.search_query:
+            self.page_request = self.io.request([f"search {{request_id}} {self.next_cursor} {LIST_PAGE_SIZE} {self.search_query}"],
+                                                lambda payload: self.show_page(generation, payload), kind="results")
+        else:
+            self.page_request = self.io.request([f"list_songs {{request_id}} {self.next_cursor} {LIST_PAGE_SIZE}"],
+                                                lambda payload: self.show_page(generation, payload), kind="page")
+
+    def on_search_typed(self):  # Search once the user pauses, not on every key
+        if self.search_timer is not None:
+            self.root.after_cancel(self.search_timer)
+        self.search_timer = self.root.after(SEARCH_DELAY, self.run_search)
+
+    def run_search(self):
+        self.search_timer = None
+        query = self.search_var.get().strip()[:MAX_QUERY]
+        if query != self.search_query:
+            self.search_query = query
+            self.load_music_library()  # answers to earlier queries are dropped with the old list
+
+    def show_page(self, generation, payload):  # Add a page of songs to the list
+        if generation != self.library_generation or not self.song_listbox.winfo_exists():
+            return  # the list was reloaded or closed meanwhile
+        self.page_request = None
+        waiting, self.after_page = self.after_page, []
+        try:
+            if payload is None:
+                raise ValueError("no reply from server")
+            page = json.loads(payload)
+        except ValueError as e:
+            print(f"Could not load songs: {e}")
+            return
+
+        if page.get("changed"):  # search results have no cursor to go stale
+            self.next_cursor = "0"  # library changed on the server, start over
+            self.music_ids = []
+            self.music_titles = []
+            self.music_keys = []
+            self.music_sizes = []
+            self.music_lengths = []
+            self.song_listbox.delete(0, tk.END)
+            for then in waiting:
+                self.after_page.append(then)
+            return self.load_more_songs()
+
+        for track_id, title, length, size, mtime in page["tracks"]:
+            self.music_ids.append(str(track_id))
+            self.music_titles.append(title)
+            self.music_keys.append(f"{track_id}-{size}-{mtime}")
+            self.music_sizes.append(size)
+            self.music_lengths.append(length)
             self.song_listbox.insert(tk.END, title)  # Add each song to the listbox
+        self.next_cursor = page["next"]
+        if not self.music_ids:
+            self.song_listbox.insert(tk.END, "No matching songs" if self.search_query else "No music files found")
+        for then in waiting:
+            then()
+
+    def on_list_scroll(self, first, last):  # Load the next page when the list is scrolled near its end
+        self.song_scrollbar.set(first, last)
+        if self.next_cursor is not None and float(last) > 0.9:
+            self.load_more_songs()
 
-    def get_song_length(self, song_path):
-        send_message("get_length")  # Request song duration
-        send_message(song_path)  # Send path of song to get length for
-        length = recieve_message()  # Get the length response
-        return float(length)  # Return length as a float
+    def get_song_length(self, song_id, callback):  # callback gets the length as a float, or None without a reply
+        self.io.request(["get_length", song_id],  # Request song duration
+                        lambda length: callback(None if length is None else float(length)), accept=is_number)
 
     def play_next_song(self):
+        if self.current_song_index + 1 >= len(self.music_ids) and self.next_cursor is not None:
+            self.load_more_songs(then=self.play_next_song)  # next song is on a page not fetched yet
+            return
         next_index = (self.current_song_index + 1) % len(self.music_titles)  # Calculate next song index with wrapping
         
         self.song_listbox.selection_clear(0, 'end')  # Clear current selection
@@ -472,9 +1413,51 @@ class App:  # Main application class
         self.song_listbox.see(prev_index)  # Ensure previous song is visible
 
         self.set_selected_song()  # Play the newly selected song
+
+    def upcoming_indices(self):  # Listbox indices of the songs that play after the current one
+        count = len(self.music_ids)
+        indices = []
+        for step in range(1, min(PREFETCH_COUNT, count - 1) + 1):
+            indices.append((self.current_song_index + step) % count)
+        return indices
+
+    def schedule_prefetch(self):
+        self.prefetcher.schedule([(self.music_ids[index], self.music_keys[index], self.music_sizes[index])
+                                  for index in self.upcoming_indices()])
+
+    def queue_next_song(self):  # Put the next song behind the current file in the mixer, if it is cached
+        indices = self.upcoming_indices()
+        if not GAPLESS or not self.playing_file or not indices:
+            return
+        path = self.song_cache.lookup(self.music_keys[indices[0]])
+        if path is None:
+            return  # still being fetched, tried again on the next progress tick
+        try:
+            pygame.mixer.music.queue(path)
+            self.queued_index = indices[0]
+        except pygame.error as e:
+            print(f"Could not queue the next song: {e}")
+
+    def advance_to_queued_song(self):  # Mixer has moved on to the queued song, follow it in the UI
+        index = self.queued_index
+        self.queued_index = None
+        self.current_song_index = index
+        self.song_listbox.selection_clear(0, 'end')
+        self.song_listbox.selection_set(index)
+        self.song_listbox.see(index)
+        self.current_song_var.set(self.music_titles[index])
+
+        self.current_song_length = self.music_lengths[index]
+        self.progress_slider.config(to=self.current_song_length)
+        mins, secs = divmod(self.current_song_length, 60)
+        self.song_length_var.set(f"{int(mins)}:{int(secs):02d}")
+        self.current_playback_time = 0
+        self.schedule_prefetch()
     
     def set_selected_song(self):
         selected_indices = self.song_listbox.curselection()  # Get current selection
+        if not selected_indices or selected_indices[0] >= len(self.music_ids):
+            return  # nothing selected, or the "No music files found" placeholder
         self.current_song_index = selected_indices[0]  # Set current song index
 
         selected_song = self.music_titles[self.current_song_index]  # Get song title
@@ -482,62 +1465,196 @@ class App:  # Main application class
         self.play_selected_song()  # Play the selected song
 
     
-    def play_selected_song(self):
+    def stop_current_song(self):  # Let go of the stream and the file of what is playing now
         if hasattr(self, 'timer_id') and self.timer_id:
             self.root.after_cancel(self.timer_id)  # Cancel any existing timer
             self.timer_id = None  # Reset timer ID
+        if getattr(self, 'jitter_buffer', None):
+            self.jitter_buffer.close()  # release a reader still waiting on the previous song
+
+        if self.partial_file is not None:
+            if hasattr(pygame.mixer.music, "unload"):
+                pygame.mixer.music.unload()  # release the file so it can be removed
+            self.song_cache.discard(self.partial_file)
+            self.partial_file = None
+        self.playing_file = False
+        self.queued_index = None  # loading a new song drops the mixer queue
+        self.on_air = False
+
+    def play_selected_song(self, start_time=None):
+        self.stop_current_song()
+
+        selected_song_id = self.music_ids[self.current_song_index]  # Get id of selected song
+        cache_key = self.music_keys[self.current_song_index]
+        cached_path = self.song_cache.lookup(cache_key)
+        self.schedule_prefetch()  # songs after this one download at a share of the link
+        if cached_path is not None:
+            self.jitter_buffer = None
+            self.start_playback(None, cached_path, position=start_time or 0)  # no network needed
+            return
+
+        interrupted = None if start_time else self.song_cache.take_interrupted(cache_key)
+        resume = None
+        messages = [f"fec {FEC_GROUP}"] if FEC_GROUP else []  # parity packets on the next stream
+        if interrupted is not None:
+            temp_filename, token, chunks = interrupted  # the last run got this far before it was closed
+            resume = (token, chunks)
+            messages = [f"resume {token} {chunks}"]  # the server sends only the rest, with the parity it had
+        elif start_time:
+            messages += ["stream_song_from", selected_song_id, f"t={start_time:.3f}"]  # server aligns this to an mp3 frame
+        else:
+            messages += ["stream_song", selected_song_id]  # Request to stream the song
+
+        if interrupted is None:
+            temp_filename = self.song_cache.new_partial()  # Download goes into the cache folder
+
+        jitter_buffer = JitterBuffer(temp_filename, None)
+        self.jitter_buffer = jitter_buffer
+        previous = self.stream_thread
 
-        selected_song_path = self.music_files[self.current_song_index]  # Get path of selected song
-        send_message("stream_song")  # Request to stream the song
-        send_message(selected_song_path)  # Send the path of song to stream
-        
-        
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.mp3')  # Create temporary file for song
-        temp_filename = temp_file.name  # Store the filename
-        temp_file.close()  # Close the file handle
-        
         def receive_stream():
-            with open(temp_filename, 'wb') as file:
-                while True:
-                    try:
-                        client_socket.settimeout(10)  # Set socket timeout
-                        data, _ = client_socket.recvfrom(8192)  # Receive data from server
-                        
-                        try:
-                            message = data.decode()  # Try to decode as message
-                            if message == "end_streaming":
-                                break  # End streaming if server signals completion
-                            elif message.startswith("error:"):
-                                messagebox.showerror("Error", message[6:])  # Show error message
-                                return
-                            elif message == "start_streaming":
-                                continue  # Continue if streaming is starting
-                        except UnicodeDecodeError:
-                            file.write(data)  # Write binary data to file if not a control message
-                            
-                    except socket.timeout:
-                        messagebox.showerror("Error", "Streaming timed out")  # Handle timeout
-                        break
+            if previous is not None:
+                previous.join()  # its last acks and timeouts must not mix with this stream
+            if jitter_buffer.closed:
+                self.song_cache.discard(temp_filename)  # skipped before it started
+                return
+            for message in messages:
+                self.stream_socket.sendto(message.encode(), (SERVER_IP, SERVER_PORT))
+            requested = False  # the UI thread was asked to start playback from the jitter buffer
+            last_checkpoint = 0
+
+            def on_progress():
+                nonlocal requested, last_checkpoint
+                if STREAMING_PLAYBACK and not requested and jitter_buffer.ready():
+                    requested = True  # this thread keeps filling the buffer while the mixer loads from it
+                    self.io.deliver(lambda _: self.play_buffer(jitter_buffer))
+                now = time.monotonic()
+                if jitter_buffer.token and not start_time and now - last_checkpoint > CHECKPOINT_INTERVAL:
+                    self.song_cache.checkpoint(temp_filename, cache_key, jitter_buffer.token, jitter_buffer.contiguous)
+                    last_checkpoint = now  # a restarted client picks the download up from here
+
+            error = receive_song(self.stream_socket, temp_filename, jitter_buffer, on_progress, resume)
+            if error is not None:
+                jitter_buffer.close()
+                self.song_cache.discard(temp_filename)
+                if resume is not None and self.jitter_buffer is jitter_buffer:
+                    self.io.deliver(lambda _: self.play_selected_song())  # server forgot the stream, start over
+                    return
+                self.io.deliver(lambda _: messagebox.showerror("Error", error))  # Show error message on the UI thread
+                return
+
+            print(f"Stream finished: first sound after "
+                  f"{(jitter_buffer.first_sound_at or time.monotonic()) - jitter_buffer.started_at:.2f}s, "
+                  f"{jitter_buffer.underruns} underruns")
+            filename = temp_filename
+            if jitter_buffer.done and not start_time:
+                filename = self.song_cache.store(temp_filename, cache_key)  # replays won't touch the network
+            elif self.jitter_buffer is jitter_buffer:
+                self.partial_file = temp_filename  # removed when the next song starts
+            else:
+                self.song_cache.discard(temp_filename)  # another song was picked meanwhile
+            if jitter_buffer.done:
+                self.io.deliver(lambda _: self.play_download(jitter_buffer, filename))
+
+        self.stream_thread = threading.Thread(target=receive_stream, daemon=True)  # Start streaming in a separate thread
+        self.stream_thread.start()
+
+    def play_buffer(self, jitter_buffer):  # Start the mixer on a buffer that is still filling, on the UI thread
+        if jitter_buffer is self.jitter_buffer and not jitter_buffer.closed:
+            jitter_buffer.playing = self.start_playback(jitter_buffer)
+
+    def play_download(self, jitter_buffer, filename):  # Whole song is here, play it from the file unless the buffer already plays
+        if jitter_buffer is self.jitter_buffer and not jitter_buffer.playing:
+            self.start_playback(None, filename, file_start=jitter_buffer.start_time)
+
+    def start_playback(self, jitter_buffer, filename=None, file_start=0.0, position=0.0):  # Start the mixer on the buffer or a finished file
+        try:
+            if jitter_buffer is not None:
+                reader = StreamReader(jitter_buffer)
+                try:
+                    pygame.mixer.music.load(reader, "mp3")  # decoder pulls audio as it arrives
+                except TypeError:
+                    pygame.mixer.music.load(reader)  # older pygame without a name hint
+                song_length = jitter_buffer.start_time + jitter_buffer.expected_size() / jitter_buffer.byte_rate
+                start_time = jitter_buffer.start_time
+            else:
+                pygame.mixer.music.load(filename)  # Load the MP3 file
+                start_time = file_start + position  # song time the file starts at, plus where to play from
+                song_length = file_start + pygame.mixer.Sound(filename).get_length()  # Get song duration
+
+            pygame.mixer.music.play(start=position)  # Start playback
+            self.play_pause_text.set("⏸")  # Set button to pause icon
+            self.music_paused = False  # Set music state to playing
+
+            self.playing_file = jitter_buffer is None
+            self.current_song_length = song_length
+            self.progress_slider.config(to=song_length)  # Configure slider to match song length
             
-            try:
-                self.play_pause_text.set("⏸")  # Set button to pause icon
-                self.music_paused = False  # Set music state to playing
-                pygame.mixer.music.load(temp_filename)  # Load the MP3 file
-                pygame.mixer.music.play()  # Start playback
+            mins, secs = divmod(song_length, 60)  # Convert seconds to minutes and seconds
+            self.song_length_var.set(f"{int(mins)}:{int(secs):02d}")  # Display total song length
 
-                song_length = pygame.mixer.Sound(temp_filename).get_length()  # Get song duration
-                self.progress_slider.config(to=song_length)  # Configure slider to match song length
-                
-                mins, secs = divmod(song_length, 60)  # Convert seconds to minutes and seconds
-                self.song_length_var.set(f"{int(mins)}:{int(secs):02d}")  # Display total song length
+            self.current_playback_time = start_time  # Playback starts where the stream starts
+            self.update_progress()  # Start progress updates
+            return True
+            
+        except Exception as e: 
+            if jitter_buffer is not None:
+                return False  # mixer can't read from the buffer, play once the download is done
+            messagebox.showerror("Error", f"Could not play the song: {str(e)}")  # Handle playback errors
+            return False
 
-                self.current_playback_time = 0  # Reset playback time
-                self.update_progress()  # Start progress updates
-                
-            except Exception as e: 
-                messagebox.showerror("Error", f"Could not play the song: {str(e)}")  # Handle playback errors
-        
-        threading.Thread(target=receive_stream, daemon=True).start()  # Start streaming in a separate thread
+    def play_station(self):  # Tune in to the server's radio, every listener hears the same song at the same time
+        self.stop_current_song()
+        self.on_air = True
+        self.prefetcher.schedule([])  # nothing to fetch ahead of a live program
+        self.current_song_var.set("📻 Tuning in...")
+
+        filename = self.song_cache.new_partial()
+        self.partial_file = filename  # never cached, removed when something else plays
+        live_buffer = LiveBuffer(filename)
+        self.jitter_buffer = live_buffer
+        previous = self.stream_thread
+
+        def receive():
+            if previous is not None:
+                previous.join()  # the song stream leaves the socket first
+            if live_buffer.closed:
+                return
+            requested = False
+
+            def on_progress():
+                nonlocal requested
+                if not requested and live_buffer.ready():
+                    requested = True
+                    self.io.deliver(lambda _: self.play_buffer(live_buffer))
+
+            def on_song(title, position, length):  # heard a little later, once the buffered audio has played
+                self.io.deliver(lambda _: self.show_station_song(live_buffer, title, position, length))
+
+            error = receive_station(self.stream_socket, filename, live_buffer, on_progress, on_song)
+            if error is not None:
+                live_buffer.close()
+                self.io.deliver(lambda _: messagebox.showerror("Error", error))
+
+        self.stream_thread = threading.Thread(target=receive, daemon=True)
+        self.stream_thread.start()
+
+    def show_station_song(self, live_buffer, title, position, length):
+        if live_buffer is not self.jitter_buffer or live_buffer.closed:
+            return  # the radio was turned off meanwhile
+        self.current_song_var.set(f"📻 {title}")
+        self.current_song_length = length
+        self.progress_slider.config(to=length)
+        mins, secs = divmod(length, 60)
+        self.song_length_var.set(f"{int(mins)}:{int(secs):02d}")
+        self.current_playback_time = max(0.0, position - live_buffer.buffer_seconds())  # what is audible now
+
+    def seek_to_slider(self):  # Restart the stream at the slider position, the server skips the bytes before it
+        if getattr(self, 'current_song_index', None) is None or self.on_air:
+            return  # the radio can't be seeked
+        position = float(self.progress_slider.get())
+        self.current_playback_time = position
+        self.play_selected_song(start_time=position)
 
     def toggle_play_pause(self):
         if not self.music_paused and pygame.mixer.music.get_busy():
@@ -553,7 +1670,17 @@ class App:  # Main application class
         if hasattr(self, 'timer_id') and self.timer_id:
             self.root.after_cancel(self.timer_id)  # Cancel existing timer
             self.timer_id = None  # Reset timer ID
-            
+
+        jitter_buffer = getattr(self, 'jitter_buffer', None)
+        if jitter_buffer is not None:
+            self.buffer_status_var.set(f"Buffer {jitter_buffer.buffer_seconds():.1f}s · "
+                                       f"{jitter_buffer.underruns} underruns")  # Show buffer level for tuning
+
+        if self.queued_index is None:
+            self.queue_next_song()  # the next song may have finished prefetching
+        elif self.current_playback_time >= self.current_song_length:
+            self.advance_to_queued_song()
+
         if pygame.mixer.music.get_busy() and not getattr(self, 'music_paused', False):
             self.current_playback_time += 1  # Increment playback time by 1 second
             
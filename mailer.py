@@ -0,0 +1,110 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")  # point at a local stand-in such as aiosmtpd for load tests
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") == "1"  # local stand-ins usually speak plain smtp
+MAIL_FROM = "musicstream@localhost"  # sender when no EMAIL account is configured
+SMTP_TIMEOUT = 10  # seconds for connecting and for each smtp command
+MAIL_QUEUE_LIMIT = 10000  # messages waiting to be sent before new ones are refused
+MAIL_BATCH = 50  # messages sent over one connection per round
+MAIL_RETRIES = 5  # attempts before a message is dropped
+MAIL_BACKOFF = 1  # seconds before the first retry, doubled for each further one
+MAIL_MAX_BACKOFF = 60
+
+
+class Outbox:  # Queue of outgoing mails, sent by one background task over a reused smtp connection
+    def __init__(self, sender, password, host=SMTP_HOST, port=SMTP_PORT, starttls=SMTP_STARTTLS):
+        self.sender = sender or MAIL_FROM
+        self.password = password
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.queue = asyncio.Queue(maxsize=MAIL_QUEUE_LIMIT)  # (to, text, attempts)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp")  # smtplib blocks, keep it off the loop
+        self.connection = None  # opened on the first message, reopened after it drops
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, to, text):  # Queue a mail, return False if the outbox is full
+        try:
+            self.queue.put_nowait((to, text, 0))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def run(self):  # Background sender, drains the queue in batches
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < MAIL_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                failed = await loop.run_in_executor(self.executor, self.deliver, batch)
+            except Exception as e:
+                print(f"Error sending mail: {e}")
+                self.disconnect()
+                failed = batch
+            for to, text, attempts in failed:
+                if attempts + 1 >= MAIL_RETRIES:
+                    print(f"Giving up on mail to {to}")
+                    self.dropped += 1
+                    continue
+                delay = min(MAIL_BACKOFF * 2 ** attempts, MAIL_MAX_BACKOFF)
+                loop.call_later(delay, self.requeue, (to, text, attempts + 1))
+
+    def requeue(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def connect(self):
+        import smtplib  # For sending emails, imported on the first mail so startup doesn't pay for it
+        connection = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT) #connect to smtp server
+        if self.starttls:
+            connection.starttls()# Start TLS encryption
+        if self.password:
+            connection.login(self.sender, self.password)
+        self.connection = connection
+
+    def disconnect(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def deliver(self, batch):  # Runs on the smtp thread, returns the messages that should be retried
+        import smtplib
+        failed = []
+        for message in batch:
+            to, text, attempts = message
+            for reconnect in (False, True):
+                try:
+                    if self.connection is None:
+                        self.connect()
+                    self.connection.sendmail(self.sender, to, text)
+                    self.sent += 1
+                    break
+                except smtplib.SMTPRecipientsRefused as e:
+                    print(f"Mail to {to} refused: {e}")  # retrying won't help
+                    self.dropped += 1
+                    break
+                except smtplib.SMTPServerDisconnected:
+                    self.disconnect()  # long-lived session timed out, reconnect once right away
+                    if reconnect:
+                        failed.append(message)
+                except (smtplib.SMTPException, OSError) as e:
+                    print(f"Error sending mail to {to}: {e}")
+                    self.disconnect()
+                    failed.append(message)
+                    break
+        return failed
+
+    def close(self):
+        self.executor.submit(self.disconnect)
+        self.executor.shutdown(wait=False)
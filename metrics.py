@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import asyncio
+from bisect import bisect_left
+
+METRICS_FILE = os.getenv("METRICS_FILE")  # dump the metrics here periodically, off when unset
+METRICS_FORMAT = os.getenv("METRICS_FORMAT", "prometheus")  # "prometheus" text or "json"
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", 15))  # seconds between dumps
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+LOOP_LAG_INTERVAL = 0.5  # seconds between event loop lag probes
+STREAM_COUNTERS = ("packets_sent", "bytes_sent", "retransmits", "parity_sent", "recovered")  # summed over streams
+
+
+class Histogram:  # Counts of observations per latency bucket, cumulative only when exported
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, fraction):  # Upper bound of the bucket holding the quantile
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self):
+        return {"count": self.count, "sum": round(self.total, 6),
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+
+class Metrics:  # Counters of one server process, cheap enough to stay on
+    def __init__(self):
+        self.started = time.time()
+        self.latencies = {}  # command -> Histogram
+        self.errors = {}  # command -> count
+        self.datagrams_received = 0
+        self.bytes_received = 0
+        self.datagrams_sent = 0  # control replies, stream packets are counted by their stream
+        self.bytes_sent = 0
+        self.closed_streams = dict.fromkeys(STREAM_COUNTERS, 0)  # totals of streams that are gone
+        self.loop_lag = Histogram()
+        self.loop_lag_max = 0.0
+        self.sources = {}  # name -> callable returning a number, read when a snapshot is taken
+
+    def observe(self, command, seconds):
+        histogram = self.latencies.get(command)
+        if histogram is None:
+            histogram = self.latencies[command] = Histogram()
+        histogram.observe(seconds)
+
+    def error(self, command):
+        self.errors[command] = self.errors.get(command, 0) + 1
+
+    def received(self, size):
+        self.datagrams_received += 1
+        self.bytes_received += size
+
+    def sent(self, size):
+        self.datagrams_sent += 1
+        self.bytes_sent += size
+
+    def stream_closed(self, stream):
+        for name in STREAM_COUNTERS:
+            self.closed_streams[name] += getattr(stream, name)
+
+    def snapshot(self, streams=()):  # Plain dict of everything, streams are the ones still open
+        totals = dict(self.closed_streams)
+        for stream in streams:
+            for name in STREAM_COUNTERS:
+                totals[name] += getattr(stream, name)
+        packets = totals["packets_sent"]
+        return {
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "commands": {command: dict(histogram.to_dict(), errors=self.errors.get(command, 0))
+                         for command, histogram in self.latencies.items()},
+            "datagrams_received": self.datagrams_received,
+            "bytes_received": self.bytes_received,
+            "datagrams_sent": self.datagrams_sent + packets,
+            "bytes_sent": self.bytes_sent + totals["bytes_sent"],
+            "stream_packets_sent": packets,
+            "retransmits": totals["retransmits"],
+            "fec_parity_sent": totals["parity_sent"],
+            "fec_recovered": totals["recovered"],
+            "loop_lag": dict(self.loop_lag.to_dict(), max=round(self.loop_lag_max, 6)),
+            **{name: source() for name, source in self.sources.items()},
+        }
+
+    def prometheus(self, streams=()):  # Same snapshot in the Prometheus text format
+        snapshot = self.snapshot(streams)
+        lines = ["# TYPE musicstream_command_seconds histogram"]
+        for command, histogram in self.latencies.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'musicstream_command_seconds_bucket{{command="{command}",le="{bound}"}} {cumulative}')
+            lines.append(f'musicstream_command_seconds_sum{{command="{command}"}} {histogram.total}')
+            lines.append(f'musicstream_command_seconds_count{{command="{command}"}} {histogram.count}')
+        lines.append("# TYPE musicstream_command_errors_total counter")
+        for command, count in self.errors.items():
+            lines.append(f'musicstream_command_errors_total{{command="{command}"}} {count}')
+        lines.append("# TYPE musicstream_loop_lag_seconds histogram")
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), self.loop_lag.counts):
+            cumulative += count
+            lines.append(f'musicstream_loop_lag_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"musicstream_loop_lag_seconds_sum {self.loop_lag.total}")
+        lines.append(f"musicstream_loop_lag_seconds_count {self.loop_lag.count}")
+        for name, value in snapshot.items():
+            if isinstance(value, (int, float)):
+                kind = "counter" if name.endswith(("_sent", "_received", "_dropped", "_recovered", "retransmits")) else "gauge"
+                suffix = "_total" if kind == "counter" else ""
+                lines.append(f"# TYPE musicstream_{name}{suffix} {kind}")
+                lines.append(f"musicstream_{name}{suffix} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def watch_loop_lag(self):  # How late the loop wakes up, a busy loop delays every client
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, loop.time() - expected)
+            self.loop_lag.observe(lag)
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+
+    def render(self, format, streams=()):
+        if format == "json":
+            return json.dumps(self.snapshot(streams))
+        return self.prometheus(streams)
+
+
+def write_metrics(path, text):  # Replace the metrics file atomically, scrapers never see half of it
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w') as file:
+        file.write(text)
+    os.replace(temp_path, path)
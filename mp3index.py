@@ -0,0 +1,135 @@
+import os
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+# Bitrates in kbit/s by [mpeg1][layer index], index 0 is "free" and 15 is invalid
+BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448, 0],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384, 0],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256, 0],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0],
+}
+SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}  # by version bits
+INDEX_CACHE_SIZE = 64  # songs whose frame index is kept in memory
+
+
+def parse_frame_header(header):  # 4 header bytes -> (frame length, samples per frame, sample rate) or None
+    if header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03  # 3 = MPEG1, 2 = MPEG2, 0 = MPEG2.5
+    layer = 4 - ((header[1] >> 1) & 0x03)  # 1, 2 or 3
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer == 4 or rate_index == 3 or bitrate_index in (0, 15):
+        return None
+
+    mpeg1 = version == 3
+    bitrate = BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    if layer == 3 and not mpeg1:
+        return 72 * bitrate // sample_rate + padding, 576, sample_rate
+    return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+
+
+def id3v2_size(data):  # Length of a leading ID3v2 tag, audio frames start after it
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]  # syncsafe integer
+    if data[5] & 0x10:
+        size += 10  # footer present
+    return 10 + size
+
+
+class FrameIndex:  # Byte offset of every audio frame in an mp3 file
+    def __init__(self, offsets, samples_per_frame, sample_rate, size):
+        self.offsets = offsets  # array of frame start offsets
+        self.samples_per_frame = samples_per_frame
+        self.sample_rate = sample_rate
+        self.size = size  # file size in bytes
+
+    @property
+    def frame_seconds(self):
+        return self.samples_per_frame / self.sample_rate if self.sample_rate else 0
+
+    @property
+    def length(self):  # Duration in seconds
+        return len(self.offsets) * self.frame_seconds
+
+    def offset_at_time(self, seconds):  # Frame boundary at or just before the given time, with its timestamp
+        if not self.offsets or not self.frame_seconds:
+            return 0, 0.0
+        frame = min(max(int(seconds / self.frame_seconds), 0), len(self.offsets) - 1)
+        return self.offsets[frame], frame * self.frame_seconds
+
+    def offset_at_byte(self, offset):  # Frame boundary at or just before the given byte, with its timestamp
+        if not self.offsets:
+            return 0, 0.0
+        frame = max(bisect_right(self.offsets, offset) - 1, 0)
+        return self.offsets[frame], frame * self.frame_seconds
+
+
+def build_frame_index(path):
+    with open(path, 'rb') as file:
+        return index_frames(file.read())
+
+
+def index_frames(data):  # FrameIndex of an mp3 already in memory
+    offsets = array('Q')
+    samples_per_frame = sample_rate = 0
+    pos = id3v2_size(data)
+    end = len(data)
+    if end >= 128 and data[-128:-125] == b"TAG":
+        end -= 128  # ID3v1 tag at the end of the file
+
+    while pos + 4 <= end:
+        frame = parse_frame_header(data[pos:pos + 4])
+        if frame is None or frame[0] < 4:
+            pos = data.find(b"\xff", pos + 1, end)  # lost sync, look for the next frame header
+            if pos < 0:
+                break
+            continue
+        length, spf, rate = frame
+        if not offsets:
+            next_frame = parse_frame_header(data[pos + length:pos + length + 4])
+            if pos + length < end and next_frame is None:
+                pos += 1  # false sync inside junk before the first frame
+                continue
+            samples_per_frame, sample_rate = spf, rate
+        offsets.append(pos)
+        pos += length
+
+    return FrameIndex(offsets, samples_per_frame, sample_rate, len(data))
+
+
+class FrameIndexCache:  # Frame indexes of recently streamed songs, rebuilt when a file changes
+    def __init__(self, max_entries=INDEX_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # path -> (size, mtime, FrameIndex), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # built from worker threads
+
+    def get(self, path):
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        index = build_frame_index(path)
+        with self.lock:
+            self.entries[path] = (stat.st_size, stat.st_mtime, index)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return index
@@ -0,0 +1,47 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))  # cost factor, each step doubles the work
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", os.cpu_count() or 2))  # threads doing password work
+BCRYPT_QUEUE_LIMIT = int(os.getenv("BCRYPT_QUEUE_LIMIT", 64))  # hashes waiting or running before new ones are refused
+
+
+class PoolBusy(Exception):  # Too many password operations queued, caller should answer "busy"
+    pass
+
+
+def hash_password(password, rounds):
+    import bcrypt  # For password hashing and verification, imported on first use to keep startup fast
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+
+
+def check_password(password, hashed):
+    import bcrypt
+    return bcrypt.checkpw(password.encode(), hashed.encode())
+
+
+class PasswordPool:  # Runs bcrypt on its own threads, bcrypt releases the GIL so the loop keeps running
+    def __init__(self, workers=BCRYPT_WORKERS, queue_limit=BCRYPT_QUEUE_LIMIT, rounds=BCRYPT_ROUNDS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.queue_limit = queue_limit
+        self.rounds = rounds
+        self.pending = 0  # operations queued or running
+
+    async def run(self, func, *args):
+        if self.pending >= self.queue_limit:
+            raise PoolBusy()
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password):
+        return await self.run(hash_password, password, self.rounds)
+
+    async def check(self, password, hashed):
+        return await self.run(check_password, password, hashed)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,62 @@
+import hmac
+import time
+from collections import OrderedDict
+
+PENDING_TTL = 600  # seconds an otp stays valid
+OTP_ATTEMPTS = 5  # wrong otps allowed before the sign-up is thrown away
+PENDING_LIMIT = 10000  # half-finished sign-ups kept at most, the oldest is dropped first
+
+
+class PendingRegistration:  # A sign-up waiting for its otp
+    __slots__ = ("name", "email", "hashed", "otp", "expires", "attempts")
+
+    def __init__(self, name, email, hashed, otp, expires):
+        self.name = name
+        self.email = email
+        self.hashed = hashed  # bcrypt hash, the plain password is never kept
+        self.otp = otp
+        self.expires = expires
+        self.attempts = 0
+
+
+class PendingRegistrations:  # Sign-ups keyed by client, bounded in time, attempts and count
+    def __init__(self, ttl=PENDING_TTL, max_attempts=OTP_ATTEMPTS, limit=PENDING_LIMIT):
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.limit = limit
+        self.entries = OrderedDict()  # key -> PendingRegistration, oldest first so expiry order is insertion order
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key, name, email, hashed, otp):
+        now = time.monotonic()
+        self.entries.pop(key, None)  # a new sign-up from the same client replaces the old one
+        self.evict_expired(now)
+        while len(self.entries) >= self.limit:
+            self.entries.popitem(last=False)
+        self.entries[key] = PendingRegistration(name, email, hashed, str(otp), now + self.ttl)
+
+    def verify(self, key, otp):  # Return (status, entry), status is "confirmed", "wrong" or "failed"
+        entry = self.entries.get(key)
+        if entry is None:
+            return "failed", None
+        if entry.expires < time.monotonic():
+            del self.entries[key]
+            return "failed", None
+        if hmac.compare_digest(entry.otp.encode(), otp.strip().encode()):  # str compare rejects non-ASCII input
+            del self.entries[key]
+            return "confirmed", entry
+        entry.attempts += 1
+        if entry.attempts >= self.max_attempts:
+            del self.entries[key]  # too many guesses
+            return "failed", None
+        return "wrong", None
+
+    def evict_expired(self, now=None):
+        now = time.monotonic() if now is None else now
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry.expires >= now:
+                break
+            del self.entries[key]
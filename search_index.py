@@ -0,0 +1,159 @@
+import re
+import heapq
+import threading
+from bisect import bisect_left, insort
+from itertools import islice
+
+SEARCH_FIELDS = (("title", 3), ("artist", 2), ("album", 1))  # Track attribute, weight of a match in it
+EXACT_BONUS = 2  # a whole word outranks a word it is only the start of
+MAX_PREFIX_WORDS = 256  # a query word that starts more index words than this only matches itself
+PREFIX_END = "\U0010ffff"  # sorts after any character, word + PREFIX_END bounds every word starting with it
+
+_words = re.compile(r"\w+")
+
+
+def tokenize(text):  # "The Beatles - Let It Be" -> ["the", "beatles", "let", "it", "be"]
+    return _words.findall(text.casefold())
+
+
+def word_weights(track):  # {word: weight of the best field of the track it appears in}
+    weights = {}
+    for name, weight in SEARCH_FIELDS:
+        for word in tokenize(getattr(track, name) or ""):
+            if weights.get(word, 0) < weight:
+                weights[word] = weight
+    return weights
+
+
+class SearchIndex:  # Words of song titles, artists and albums, for ranked prefix search
+    def __init__(self):
+        self.postings = {}  # word -> {track_id: weight of the best field it appears in}
+        self.ranked = {}  # (word, weight) -> [(title, track_id)] sorted, so the best matches are read first
+        self.words = []  # every word in the index, sorted, so a prefix is a slice of it
+        self.fields = {}  # track_id -> {word: weight of the best field it appears in}
+        self.versions = {}  # track_id -> (size, mtime) of the indexed version
+        self.titles = {}  # track_id -> casefolded title, orders songs with equal scores
+        self.lock = threading.Lock()  # updated on the catalog refresh thread, searched on the loop thread
+
+    def __len__(self):
+        return len(self.versions)
+
+    def sync(self, tracks):  # Follow the catalog's {track_id: Track}, only new, changed and removed songs cost anything
+        if not self.versions:
+            self.build(tracks)
+            return
+        for track_id in [track_id for track_id in self.versions if track_id not in tracks]:
+            with self.lock:
+                self.remove(track_id)
+        for track in list(tracks.values()):
+            if self.versions.get(track.track_id) != (track.size, track.mtime):
+                self.add(track)
+
+    def build(self, tracks):  # Index a whole library at once, sorting each list once instead of per song
+        postings, ranked, fields, versions, titles = {}, {}, {}, {}, {}
+        for track in list(tracks.values()):
+            weights = fields[track.track_id] = word_weights(track)
+            versions[track.track_id] = (track.size, track.mtime)
+            title = titles[track.track_id] = track.title.casefold()
+            for word, weight in weights.items():
+                postings.setdefault(word, {})[track.track_id] = weight
+                ranked.setdefault((word, weight), []).append((title, track.track_id))
+        for songs in ranked.values():
+            songs.sort()
+        with self.lock:
+            self.postings, self.ranked, self.fields, self.versions, self.titles = postings, ranked, fields, versions, titles
+            self.words = sorted(postings)
+
+    def add(self, track):
+        weights = word_weights(track)
+        title = track.title.casefold()
+        with self.lock:  # held per song, a big sync never keeps a search waiting for long
+            self.remove(track.track_id)
+            self.fields[track.track_id] = weights
+            self.versions[track.track_id] = (track.size, track.mtime)
+            self.titles[track.track_id] = title
+            for word, weight in weights.items():
+                posting = self.postings.get(word)
+                if posting is None:
+                    posting = self.postings[word] = {}
+                    insort(self.words, word)
+                posting[track.track_id] = weight
+                insort(self.ranked.setdefault((word, weight), []), (title, track.track_id))
+
+    def remove(self, track_id):  # Called with the lock held
+        weights = self.fields.pop(track_id, None)
+        if weights is None:
+            return
+        title = self.titles.pop(track_id)
+        del self.versions[track_id]
+        for word, weight in weights.items():
+            ranked = self.ranked[word, weight]
+            del ranked[bisect_left(ranked, (title, track_id))]
+            if not ranked:
+                del self.ranked[word, weight]
+            posting = self.postings[word]
+            del posting[track_id]
+            if not posting:
+                del self.postings[word]
+                del self.words[bisect_left(self.words, word)]
+
+    def expand(self, word):  # Index words starting with word, called with the lock held
+        start = bisect_left(self.words, word)
+        end = bisect_left(self.words, word + PREFIX_END, start)
+        if end - start > MAX_PREFIX_WORDS:
+            return [word] if word in self.postings else []  # too short to mean anything yet
+        return self.words[start:end]
+
+    def search(self, query, offset, limit):  # Track ids of the requested page, best first, and whether more follow
+        words = list(dict.fromkeys(tokenize(query)))
+        if not words:
+            return [], False
+        with self.lock:
+            if len(words) == 1:
+                page = list(islice(self.ranked_matches(words[0]), offset, offset + limit + 1))
+            else:
+                page = self.scored_matches(words, offset + limit + 1)[offset:]
+        return page[:limit], len(page) > limit
+
+    def ranked_matches(self, word):  # Songs matching one word, best first, read lazily from the sorted lists
+        tiers = {}  # score -> lists of (title, track_id) holding songs with that score
+        for indexed in self.expand(word):
+            bonus = EXACT_BONUS if indexed == word else 1
+            for _, weight in SEARCH_FIELDS:
+                ranked = self.ranked.get((indexed, weight))
+                if ranked:
+                    tiers.setdefault(weight * bonus, []).append(ranked)
+        seen = set()  # a song under several words of the prefix is listed once, in its best tier
+        for score in sorted(tiers, reverse=True):
+            for _, track_id in heapq.merge(*tiers[score]):
+                if track_id not in seen:
+                    seen.add(track_id)
+                    yield track_id
+
+    def scored_matches(self, words, count):  # Best count songs matching every word
+        expansions = sorted(((word, self.expand(word)) for word in words), key=lambda item: len(item[1]))
+        candidates = None
+        for _, expanded in expansions:
+            if len(expanded) == 1:
+                matching = self.postings[expanded[0]].keys()
+            else:
+                matching = set().union(*(self.postings[indexed] for indexed in expanded))
+            candidates = matching if candidates is None else candidates & matching
+            if not candidates:
+                return []
+        longer = [(word, set(expanded) - {word}) for word, expanded in expansions]
+        scores = {track_id: self.score(track_id, longer) for track_id in candidates}
+        titles = self.titles
+        return heapq.nsmallest(count, scores, key=lambda track_id: (-scores[track_id], titles[track_id], track_id))
+
+    def score(self, track_id, longer):  # Sum over the query words of their best match in the song
+        total = 0
+        weights = self.fields[track_id]
+        for word, longer_words in longer:  # longer_words: index words the query word is the start of
+            best = weights.get(word, 0) * EXACT_BONUS
+            if longer_words and best < SEARCH_FIELDS[0][1] * EXACT_BONUS:  # a longer word may sit in a better field
+                for indexed, weight in weights.items():
+                    if weight > best and indexed in longer_words:
+                        best = weight
+            total += best
+        return total
@@ -1,151 +1,641 @@
-import socket  
+import socket
+import asyncio  # For the event-driven datagram server
 import random
-import smtplib  # For sending emails
 import os
+import sys
 import json
 import time
+import signal
+import secrets
 from dotenv import load_dotenv # For loading environment variables
-from mutagen.mp3 import MP3
-import bcrypt  # For password hashing and verification
+load_dotenv()  # before the local modules below read their settings
+from streaming import SongStream, CHUNK_SIZE, STREAM_LINGER, FEC_MIN_GROUP, FEC_MAX_GROUP, parse_ranges, prefetch_pacer
+from mp3index import FrameIndexCache
+from track_cache import TrackCache, TRACK_CACHE_BYTES
+from catalog import Catalog, REFRESH_INTERVAL
+from station import Station, STATION_GROUP, parse_group, enable_multicast
+from user_store import UserStore
+from passwords import PasswordPool, PoolBusy
+from mailer import Outbox
+from registrations import PendingRegistrations
+from metrics import Metrics, write_metrics, METRICS_FILE, METRICS_FORMAT, METRICS_INTERVAL
 
 SERVER_IP = "localhost"
-SERVER_PORT = 5000
+SERVER_PORT = int(os.getenv("SERVER_PORT", 5000))
 BUFFER_SIZE = 1024
-
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # create UDP socket
-server_socket.bind((SERVER_IP, SERVER_PORT))  #Bind sockets to address and port
-
-print(f"Server listening on {SERVER_IP}:{SERVER_PORT}")
-
-load_dotenv()
-
-def send_message(message, client_address):   #function to send messages to client 
-    server_socket.sendto(message.encode(), client_address)
-
-def recieve_message():  #function to receive messages from client 
-    response, _ = server_socket.recvfrom(BUFFER_SIZE)
-    return response.decode()
+MAX_DATAGRAM = 1000  # replies split into fragments no larger than this, fits the client's 1024 byte buffer
+MAX_PAGE_SIZE = 200  # songs per list_songs page
+SESSION_ARG_TIMEOUT = 30  # seconds a half-finished command may wait for its next argument
+SESSION_IDLE_TIMEOUT = 600  # seconds before an inactive client session is dropped
+RESUME_TTL = 300  # seconds a stream can still be resumed after its client was last heard from
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", 1))  # processes sharing the port, 0 for one per core
+WORKER_RESTART_DELAY = 1  # seconds before a crashed worker is started again
 
 EMAIL = os.getenv("EMAIL")
 EMAIL_PWD = os.getenv("EMAIL_PWD")
-email_server = smtplib.SMTP("smtp.gmail.com", 587) #connect to gmail smtp server
-email_server.starttls()# Start TLS encryption
-email_server.login(EMAIL, EMAIL_PWD)
-
-music_folder_path = r"path to music files" 
-
-
-while True:
-    try:
-        data, client_address = server_socket.recvfrom(BUFFER_SIZE)
-        text = data.decode()
-
-        if text == "register":
-            name = recieve_message()  #get username 
-            email = recieve_message() #get email address 
-            pswd = recieve_message() #get password
-
-            hashed = bcrypt.hashpw(pswd.encode(), bcrypt.gensalt()).decode()  #hash password for security
-
-            print(name, email, hashed)
-            otp = random.randint(10000, 99999)
-
-            print(otp)
-
-            email_server.sendmail(EMAIL, email, f"Your OTP is {otp}")  #send OTP via email
-
-            client_otp = recieve_message()
-            print(client_otp)
-            register_msg = "failed"
-
-            if int(client_otp) == otp:
-                register_msg = "confirmed"
-                obj = {'name': name, 'pswd': hashed, 'email': email}
-
-                if os.path.exists("data.json"):
-                    with open("data.json", 'r') as file:
-                        data = json.load(file) #load existing data
-                else:
-                    data = []
-
-                data.append(obj) #add new user to data
-                with open("data.json", 'w') as file:
-                    json.dump(data, file, indent=2)
-    
-            send_message(register_msg, client_address)
 
-        elif text == "login":  #handle user login 
-            login_name = recieve_message() #load user data
-            login_pwd = recieve_message()
-
-            with open('data.json', 'r') as file:
-                json_obj = json.load(file)
-                login_msg = "failed"
-                for obj in json_obj:
-                    if obj["name"] == login_name and bcrypt.checkpw(login_pwd.encode(), obj["pswd"].encode()):
+music_folder_path = os.getenv("MUSIC_FOLDER", r"path to music files")
+
+# Number of follow-up datagrams each command expects before it can run
+COMMAND_ARGS = {
+    "register": 3,  # name, email, password
+    "verify_otp": 1,  # otp typed by the user after register
+    "login": 2,  # name, password
+    "song": 0,
+    "get_length": 1,  # song id (or path from older clients)
+    "stream_song": 1,  # song id (or path from older clients)
+    "stream_song_from": 2,  # song id, start as "t=<seconds>" or "b=<byte offset>"
+    "prefetch_song": 2,  # song id, speed as a multiple of the song's bitrate
+}
+
+# Stream control commands sent as one datagram: "nack <stream id> <ranges>"
+INLINE_COMMANDS = {
+    "nack": 2,  # stream id, missing sequence ranges
+    "stream_done": 1,  # stream id
+    "ack": 5,  # stream id, contiguous packets, highest sequence read, free buffer in packets, chunks recovered
+    "list_songs": 3,  # request id, cursor, page size
+    "stats": 1,  # request id, answered with the server metrics as json
+    "fec": 1,  # chunks per parity packet for the client's next streams, 0 turns parity off
+    "search": 4,  # request id, offset, page size, query
+    "join_station": 0,  # listen to the station, sent again now and then to stay subscribed
+    "leave_station": 0,
+    "resume": 2,  # token from start_streaming, first packet missing as a sequence number or "b=<byte offset>"
+}
+TEXT_COMMANDS = {"search"}  # inline commands whose last argument is free text that may hold spaces
+
+
+def hit_ratio(cache):
+    lookups = cache.hits + cache.misses
+    return round(cache.hits / lookups, 4) if lookups else None
+
+
+class ClientSession:  # Per-client state machine, keyed by client address
+    def __init__(self, client_address):
+        self.client_address = client_address
+        self.command = None  # command currently collecting arguments
+        self.args = []  # arguments received so far for that command
+        self.stream_task = None  # asyncio task of the running song stream
+        self.streams = {}  # stream_id -> SongStream, kept for a while to answer nacks
+        self.fec_group = 0  # parity group size the client asked for, 0 for none
+        self.checking_login = False  # a login is waiting for the password pool, resends of it are dropped
+        self.last_seen = time.monotonic()
+
+    def feed(self, text):  # Consume one datagram, return (command, args) once a command is complete
+        now = time.monotonic()
+        if self.command and now - self.last_seen > SESSION_ARG_TIMEOUT:
+            self.command = None  # client abandoned the previous command
+            self.args = []
+        self.last_seen = now
+
+        parts = text.split(" ")
+        if parts[0] in INLINE_COMMANDS:  # also while a command waits for arguments, acks of a stream keep coming
+            count = INLINE_COMMANDS[parts[0]]
+            if parts[0] in TEXT_COMMANDS:
+                parts = text.split(" ", count)
+            if len(parts) - 1 == count:
+                return parts[0], parts[1:]
+            if self.command is None:
+                return None, None  # malformed control message
+
+        if self.command is None:
+            if text not in COMMAND_ARGS:
+                return None, None  # unknown command, ignore it
+            self.command = text
+            self.args = []
+        else:
+            self.args.append(text)
+
+        if len(self.args) < COMMAND_ARGS[self.command]:
+            return None, None  # still waiting for more arguments
+
+        command, args = self.command, self.args
+        self.command = None
+        self.args = []
+        return command, args
+
+
+class StreamTicket:  # What a resume needs to continue a stream with the same packets, from any address
+    def __init__(self, token, track, start_offset, start_time, fec_group):
+        self.token = token  # sent to the client in start_streaming
+        self.track_id = track.track_id
+        self.version = (track.size, track.mtime)  # an edited song can't be continued from the old bytes
+        self.start_offset = start_offset  # byte of sequence number 0, a resume keeps the numbering
+        self.start_time = start_time
+        self.fec_group = fec_group
+        self.session = None  # session last sending or asking for the stream, its last_seen ages the ticket
+        self.task = None  # task sending the stream, stopped when it is resumed elsewhere
+
+
+class MusicServer(asyncio.DatagramProtocol):  # Dispatches datagrams to per-client sessions
+    def __init__(self, catalog, users, outbox, sock=None, workers=1):
+        self.transport = None
+        self.socket = sock  # the transport's socket, streams send cached audio on it directly
+        self.catalog = catalog  # index of the music folder
+        self.users = users  # registered users by name
+        self.outbox = outbox  # otp mails, sent in the background
+        self.registrations = PendingRegistrations()  # sign-ups waiting for their otp
+        self.passwords = PasswordPool()  # bcrypt runs here, never on the loop thread
+        self.tasks = set()  # running handler coroutines, kept so they aren't garbage collected
+        self.sessions = {}  # client_address -> ClientSession
+        self.tickets = {}  # token -> StreamTicket of streams a client may resume
+        self.frame_indexes = FrameIndexCache()  # mp3 frame offsets for seeking
+        self.track_cache = TrackCache(TRACK_CACHE_BYTES // workers)  # popular songs in memory, shared by all their listeners
+        self.station = None  # radio played by this process, None in workers that leave it to worker 0
+        self.metrics = Metrics()
+        self.metrics.sources.update({
+            "sessions": lambda: len(self.sessions),
+            "active_streams": lambda: sum(1 for session in self.sessions.values()
+                                          if session.stream_task is not None and not session.stream_task.done()),
+            "running_handlers": lambda: len(self.tasks),
+            "resumable_streams": lambda: len(self.tickets),
+            "pending_registrations": lambda: len(self.registrations),
+            "password_queue": lambda: self.passwords.pending,
+            "mail_queue": lambda: self.outbox.queue.qsize(),
+            "mails_sent": lambda: self.outbox.sent,
+            "mails_dropped": lambda: self.outbox.dropped,
+            "catalog_tracks": lambda: len(self.catalog.ordered),
+            "search_index_tracks": lambda: len(self.catalog.search),
+            "track_cache_bytes": lambda: self.track_cache.used,
+            "track_cache_hit_ratio": lambda: hit_ratio(self.track_cache),
+            "frame_index_cache_hit_ratio": lambda: hit_ratio(self.frame_indexes),
+            "station_listeners": lambda: len(self.station.listeners) if self.station else 0,
+            "station_packets_sent": lambda: self.station.packets_sent if self.station else 0,
+            "station_bytes_sent": lambda: self.station.bytes_sent if self.station else 0,
+        })
+        self.handlers = {
+            "register": self.handle_register,
+            "verify_otp": self.handle_verify_otp,
+            "login": self.handle_login,
+            "song": self.handle_song,
+            "get_length": self.handle_get_length,
+            "stream_song": self.handle_stream_song,
+            "stream_song_from": self.handle_stream_song_from,
+            "prefetch_song": self.handle_prefetch_song,
+            "nack": self.handle_nack,
+            "stream_done": self.handle_stream_done,
+            "ack": self.handle_ack,
+            "list_songs": self.handle_list_songs,
+            "stats": self.handle_stats,
+            "fec": self.handle_fec,
+            "search": self.handle_search,
+            "join_station": self.handle_join_station,
+            "leave_station": self.handle_leave_station,
+            "resume": self.handle_resume,
+        }
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send_message(self, message, client_address):   #function to send messages to client
+        data = message.encode()
+        self.transport.sendto(data, client_address)
+        self.metrics.sent(len(data))
+
+    def send_fragments(self, kind, request_id, payload, client_address):  # Split a large reply into numbered datagrams
+        body_size = MAX_DATAGRAM - 40  # room for the "<kind> <request id> <index> <count>" line
+        count = max(1, -(-len(payload) // body_size))
+        for index in range(count):
+            header = f"{kind} {request_id} {index} {count}\n".encode()
+            fragment = header + payload[index * body_size:(index + 1) * body_size]
+            self.transport.sendto(fragment, client_address)
+            self.metrics.sent(len(fragment))
+
+    def datagram_received(self, data, client_address):
+        self.metrics.received(len(data))
+        session = self.sessions.get(client_address)
+        if session is None:
+            session = self.sessions[client_address] = ClientSession(client_address)
+
+        try:
+            text = data.decode()
+        except UnicodeDecodeError:
+            return  # commands and arguments are always text
+
+        command, args = session.feed(text)
+        if command is None:
+            return
+
+        started = time.perf_counter()
+        try:
+            result = self.handlers[command](session, *args)
+        except Exception as e:
+            print(f"Error handling {command} from {client_address}: {e}")
+            self.metrics.error(command)
+            return
+
+        if asyncio.iscoroutine(result):  # handler waits on a worker pool, let it finish in the background
+            task = asyncio.ensure_future(result)
+            self.tasks.add(task)
+            task.add_done_callback(lambda task: self.handler_done(task, command, client_address, started))
+        else:
+            self.metrics.observe(command, time.perf_counter() - started)
+
+    def handler_done(self, task, command, client_address, started):
+        self.tasks.discard(task)
+        self.metrics.observe(command, time.perf_counter() - started)  # includes the wait for the worker pool
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error handling {command} from {client_address}: {task.exception()}")
+            self.metrics.error(command)
+
+    def error_received(self, exc):
+        print(f"Socket error: {exc}")
+
+    def expire_sessions(self):  # Drop sessions that have been silent for too long
+        now = time.monotonic()
+        for client_address, session in list(self.sessions.items()):
+            streaming = session.stream_task is not None and not session.stream_task.done()
+            if not streaming and now - session.last_seen > SESSION_IDLE_TIMEOUT:
+                for stream in session.streams.values():
+                    stream.close()
+                del self.sessions[client_address]
+        for token, ticket in list(self.tickets.items()):
+            if now - ticket.session.last_seen > RESUME_TTL:
+                del self.tickets[token]
+        self.registrations.evict_expired()
+
+    async def handle_register(self, session, name, email, pswd):
+        if await self.users.exists(name):  # read on the store's thread when the name isn't in its index
+            print(f"Name already registered: {name}")
+            return  # verify_otp will answer "failed"
+
+        try:
+            hashed = await self.passwords.hash(pswd)  #hash password for security
+        except PoolBusy:
+            print(f"Password pool busy, refusing registration of {name}")
+            return
+
+        print(name, email, hashed)
+        otp = random.randint(10000, 99999)
+
+        print(otp)
+
+        if not self.outbox.send(email, f"Subject: MusicStream OTP\n\nYour OTP is {otp}"):  #queue OTP mail
+            print(f"Mail outbox full, refusing registration of {name}")
+            return
+        self.registrations.add(session.client_address, name, email, hashed, otp)
+
+    async def handle_verify_otp(self, session, client_otp):
+        print(client_otp)
+        register_msg, entry = self.registrations.verify(session.client_address, client_otp)
+
+        if entry is not None and not await self.users.add(entry.name, entry.hashed, entry.email): #add new user
+            register_msg = "failed"  # name was taken while the otp was on its way
+
+        self.send_message(register_msg, session.client_address)
+
+    def handle_login(self, session, login_name, login_pwd):  #handle user login
+        if session.checking_login:
+            return None  # answered once the check already queued finishes, a second one would only wait behind it
+        session.checking_login = True  # set before the check is scheduled, so a resend right behind it sees it
+        return self.check_login(session, login_name, login_pwd)
+
+    async def check_login(self, session, login_name, login_pwd):
+        login_msg = "failed"
+        try:
+            obj = await self.users.get(login_name)
+            if obj is not None:
+                try:
+                    if await self.passwords.check(login_pwd, obj["pswd"]):
                         login_msg = "confirmed"
-                        break
-                send_message(login_msg, client_address)
-        
-        elif text == "song":  #handle song list request 
-            music_files = [] 
-            music_titles = []
-
-            if not os.path.exists(music_folder_path): #check if music folder exists
-                print("Error", f"Folder not found: {music_folder_path}")
-                music_files = []
-                music_titles = ["No music files found"]
-
-            else:
-                for file in os.listdir(music_folder_path):  #loop through files in directory 
-                    if file.endswith('.mp3'): #check if file is MP3
-                        music_files.append(os.path.join(music_folder_path, file))
-                        music_titles.append(os.path.splitext(file)[0])
-                   
-                if not music_files:
-                    music_titles = ["No music files found"]
-            
-            send_message(str(music_files), client_address)
-            send_message(str(music_titles), client_address)
-
-        elif text == "get_length":  #handle song length request 
-            song_path = recieve_message()
-            try:
-                audio = MP3(song_path)
-                print(audio.info.length, type(audio.info.length))
-                send_message(str(audio.info.length), client_address) #send length to client
-            except Exception as e:
-                print(f"Error getting song length: {e}")
-                send_message("0", client_address)
-
-
-        elif text == "stream_song":  #handle song streaming request 
-            song_path = recieve_message()
+                except PoolBusy:
+                    login_msg = "busy"  # too many logins queued, client should retry
+        finally:
+            session.checking_login = False
+        self.send_message(login_msg, session.client_address)
+
+    def handle_song(self, session):  #handle song list request
+        music_files, music_titles = self.catalog.song_reply  # built when the catalog last changed
+        self.send_message(music_files, session.client_address)
+        self.send_message(music_titles, session.client_address)
+
+    def handle_list_songs(self, session, request_id, cursor, limit):  #one page of the song list
+        version, _, offset = cursor.rpartition(".")  # cursor is "<catalog version>.<offset>"
+        offset = max(int(offset), 0)
+        limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+        catalog = self.catalog
+        tracks = catalog.page(offset, limit)
+        next_offset = offset + len(tracks)
+        reply = {
+            "version": catalog.version,
+            "changed": bool(version) and int(version) != catalog.version,  # listing moved since the first page
+            "total": len(catalog.ordered),
+            "next": f"{catalog.version}.{next_offset}" if next_offset < len(catalog.ordered) else None,
+            "tracks": tracks,
+        }
+        payload = json.dumps(reply, separators=(",", ":")).encode()
+        self.send_fragments("page", request_id, payload, session.client_address)
+
+    def handle_search(self, session, request_id, offset, limit, query):  #one page of songs matching what the user typed
+        offset = max(int(offset), 0)
+        limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+        tracks, more = self.catalog.find(query, offset, limit)
+        reply = {
+            "next": offset + limit if more else None,
+            "tracks": tracks,
+        }
+        payload = json.dumps(reply, separators=(",", ":")).encode()
+        self.send_fragments("results", request_id, payload, session.client_address)
+
+    def handle_get_length(self, session, song_ref):  #handle song length request
+        track = self.catalog.resolve(song_ref)
+        if track is None:
+            print(f"Error getting song length: unknown song {song_ref}")
+            self.send_message("0", session.client_address)
+            return
+        self.send_message(str(track.length), session.client_address) #send length to client
+
+    def handle_stream_song(self, session, song_ref, start=None, share=None):  #handle song streaming request
+        if session.stream_task is not None and not session.stream_task.done():
+            session.stream_task.cancel()  # a new request replaces the client's previous stream
+        if self.station is not None and share is None:
+            self.station.leave(session.client_address)  # and the station the client was listening to
+        track = self.catalog.resolve(song_ref)
+        if track is None:
+            self.send_message(f"error: unknown song {song_ref}", session.client_address)
+            return
+        session.stream_task = asyncio.ensure_future(self.stream_song(session, track, start, share))
+
+    def handle_stream_song_from(self, session, song_ref, start):  #stream from a time or byte offset
+        self.handle_stream_song(session, song_ref, start)
+
+    def handle_prefetch_song(self, session, song_ref, share):  #background download of an upcoming song
+        try:
+            share = float(share)
+        except ValueError:
+            self.send_message(f"error: bad prefetch share {share}", session.client_address)
+            return
+        self.handle_stream_song(session, song_ref, share=share)
+
+    async def find_start(self, song_path, start):  # "t=63.5" or "b=1048576" -> (frame offset, frame time)
+        kind, _, value = start.partition("=")
+        if kind not in ("t", "b"):
+            raise ValueError(f"bad start position: {start}")
+        loop = asyncio.get_running_loop()
+        index = await loop.run_in_executor(None, self.frame_indexes.get, song_path)  # reads the whole file once
+        if kind == "t":
+            return index.offset_at_time(float(value))
+        return index.offset_at_byte(int(value))
+
+    async def stream_song(self, session, track, start=None, share=None, ticket=None, first_seq=0):
+        requested = time.perf_counter()
+        client_address = session.client_address
+        song_path = track.path
+        bitrate = track.bitrate  # pace the stream at the song's own bitrate
+        try:
+            start_offset, start_time = 0, 0.0
+            if ticket is not None:
+                start_offset, start_time = ticket.start_offset, ticket.start_time  # the layout the client has
+            elif start is not None:
+                start_offset, start_time = await self.find_start(song_path, start)
+            pacer = prefetch_pacer(bitrate, share) if share is not None else None  # prefetches leave room for playback
+            data = await asyncio.get_running_loop().run_in_executor(None, self.track_cache.get, song_path)
+            fec_group = session.fec_group if share is None else 0  # a prefetch has time to wait for resends
+            if ticket is not None:
+                fec_group = ticket.fec_group  # the client's parity groups are numbered by the first stream
+            token = ticket.token if ticket is not None else None
+            if token is None and share is None:
+                token = secrets.token_hex(8)  # playback can be resumed, a prefetch just starts over
+            stream = SongStream(self.transport, client_address, song_path, bitrate, start_offset, start_time, pacer,
+                                data, self.socket, fec_group, token, first_seq)
+        except Exception as e:
+            print(f"Error streaming song: {e}")
+            self.send_message(f"error: {str(e)}", client_address)
+            self.metrics.error("stream_start")
+            return
+
+        session.streams[stream.stream_id] = stream
+        if token is not None:
+            if ticket is None:
+                ticket = self.tickets[token] = StreamTicket(token, track, start_offset, start_time, fec_group)
+            ticket.session = session
+            ticket.task = asyncio.current_task()
+        self.metrics.observe("stream_start", time.perf_counter() - requested)  # seek lookup and cache load
+        try:
+            await stream.run(self.send_message)
+        except asyncio.CancelledError:
+            self.close_stream(session, stream.stream_id)
+            raise
+        except Exception as e:
+            print(f"Error streaming song: {e}")
+            self.send_message(f"error: {str(e)}", client_address)
+            self.close_stream(session, stream.stream_id)
+            return
+
+        # keep the stream around so the client can still recover lost packets
+        asyncio.get_running_loop().call_later(STREAM_LINGER, self.close_stream, session, stream.stream_id)
+
+    def handle_resume(self, session, token, position):  #continue a stalled stream, from the same or a new address
+        ticket = self.tickets.get(token)
+        track = self.catalog.by_id.get(ticket.track_id) if ticket is not None else None
+        if track is None or (track.size, track.mtime) != ticket.version:
+            self.send_message("error: stream can't be resumed", session.client_address)  # client starts over
+            return
+        kind, _, value = position.partition("=")
+        first_seq = max(int(value) // CHUNK_SIZE if kind == "b" else int(position), 0)
+        if ticket.fec_group:
+            first_seq -= first_seq % ticket.fec_group  # whole parity groups, so each parity covers what it says
+        if ticket.task is not None and not ticket.task.done():
+            ticket.task.cancel()  # may still be sending to the address the client had before the drop
+        if session.stream_task is not None and not session.stream_task.done():
+            session.stream_task.cancel()
+        if self.station is not None:
+            self.station.leave(session.client_address)
+        ticket.session = session  # a resume keeps the ticket alive
+        session.stream_task = asyncio.ensure_future(self.stream_song(session, track, ticket=ticket, first_seq=first_seq))
+
+    def close_stream(self, session, stream_id):
+        stream = session.streams.pop(stream_id, None)
+        if stream is not None:
+            self.metrics.stream_closed(stream)
+            stream.close()
+
+    def handle_nack(self, session, stream_id, ranges):  #client reports missing packets
+        stream = session.streams.get(int(stream_id))
+        if stream is None:
+            return  # stream already closed
+        stream.retransmit(parse_ranges(ranges))
+
+    def handle_ack(self, session, stream_id, contiguous, highest, free, recovered):  #client reports progress, paces the stream
+        stream = session.streams.get(int(stream_id))
+        if stream is None:
+            return
+        stream.on_ack(int(contiguous), int(highest), max(int(free), 1), int(recovered))
+
+    def handle_fec(self, session, group):  #client asks for parity packets on lossy links
+        group = int(group)
+        session.fec_group = min(max(group, FEC_MIN_GROUP), FEC_MAX_GROUP) if group > 0 else 0
+
+    def handle_join_station(self, session):  #start or keep listening to the radio
+        if session.stream_task is not None and not session.stream_task.done():
+            session.stream_task.cancel()  # the radio replaces the song the client was streaming
+        for stream_id in list(session.streams):
+            self.close_stream(session, stream_id)
+        if self.station is not None:
+            for reply in self.station.join(session.client_address):
+                self.send_message(reply, session.client_address)
+        elif STATION_GROUP:
+            self.send_message(f"station_joined {STATION_GROUP}", session.client_address)  # worker 0 multicasts it
+        else:
+            self.send_message("error: the station needs STATION_GROUP with several workers", session.client_address)
+
+    def handle_leave_station(self, session):
+        if self.station is not None:
+            self.station.leave(session.client_address)
+
+    def handle_stats(self, session, request_id):  #server metrics, for monitoring and load tests
+        payload = json.dumps(self.metrics.snapshot(self.open_streams())).encode()
+        self.send_fragments("stats", request_id, payload, session.client_address)
+
+    def open_streams(self):  # A list, metrics may walk it more than once
+        return [stream for session in self.sessions.values() for stream in session.streams.values()]
+
+    def handle_stream_done(self, session, stream_id):  #client has every packet of the stream, or gave up on it
+        stream = session.streams.get(int(stream_id))
+        if stream is not None and stream.token is not None:
+            self.tickets.pop(stream.token, None)  # nothing left to resume
+        self.close_stream(session, int(stream_id))
+
+
+async def expire_sessions_periodically(server):
+    while True:
+        await asyncio.sleep(60)
+        server.expire_sessions()
+
+
+async def dump_metrics_periodically(server, path):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        try:
+            text = server.metrics.render(METRICS_FORMAT, server.open_streams())  # read on the loop thread
+            await loop.run_in_executor(None, write_metrics, path, text)
+        except Exception as e:
+            print(f"Error writing metrics: {e}")
+
+
+async def refresh_catalog_periodically(catalog, owner=True):  # First check right away, the server is already serving the snapshot
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            # one process stats the files and saves the snapshot, other workers load the snapshot it saved
+            if await loop.run_in_executor(None, catalog.refresh if owner else catalog.reload):
+                print(f"Catalog has {len(catalog.tracks)} songs")
+            await loop.run_in_executor(None, catalog.update_search)  # built here, not at startup, a restart serves at once
+        except Exception as e:
+            print(f"Error refreshing catalog: {e}")
+        await asyncio.sleep(REFRESH_INTERVAL)
+
+
+def bind_socket(reuse_port=False):  # made here so streams can sendmsg on it
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        # the kernel picks the worker by hashing the client's address, so a client always reaches the same one
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((SERVER_IP, SERVER_PORT))
+    return sock
+
+
+async def serve(catalog, worker=None, workers=1):  # Run one server process, worker is None when it is the only one
+    loop = asyncio.get_running_loop()
+    users = UserStore()  # migrates data.json on first start
+    outbox = Outbox(EMAIL, EMAIL_PWD)  # connects to the smtp server on the first mail
+    if worker is None and catalog.load():  # last snapshot, changed files are re-read once the server is up
+        print(f"Catalog snapshot has {len(catalog.tracks)} songs")
+
+    sock = bind_socket(reuse_port=worker is not None)
+    transport, server = await loop.create_datagram_endpoint(
+        lambda: MusicServer(catalog, users, outbox, sock, workers), sock=sock)  # create UDP endpoint
+    if worker is None:
+        print(f"Server listening on {SERVER_IP}:{SERVER_PORT}")
+    else:
+        server.metrics.sources["worker"] = lambda: worker
+        print(f"Worker {worker} (pid {os.getpid()}) listening on {SERVER_IP}:{SERVER_PORT}")
+
+    owner = not worker  # the only process, or worker 0, keeps the catalog snapshot up to date and plays the station
+    try:
+        background = [expire_sessions_periodically(server), refresh_catalog_periodically(catalog, owner),
+                      outbox.run(), server.metrics.watch_loop_lag()]
+        if owner:
+            group = None
+            if STATION_GROUP:
+                group = parse_group(STATION_GROUP)
+                enable_multicast(sock, SERVER_IP)
+            server.station = Station(catalog, transport, group)
+            background.append(server.station.run())
+        if METRICS_FILE:
+            path = METRICS_FILE if worker is None else f"{METRICS_FILE}.{worker}"  # one file per worker
+            background.append(dump_metrics_periodically(server, path))
+        await asyncio.gather(*background)
+    finally:
+        transport.close()
+        outbox.close()
+        server.passwords.shutdown()
+        users.close()
+
+
+def run_worker(catalog, worker, workers):  # Body of a forked worker process, never returns
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    code = 0
+    try:
+        asyncio.run(serve(catalog, worker, workers))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"Worker {worker} failed: {e}")
+        code = 1
+    finally:
+        sys.stdout.flush()
+        os._exit(code)  # don't run the parent's cleanup in the child
+
+
+def run_workers(workers):  # Fork workers sharing the port, restart any that die
+    catalog = Catalog(music_folder_path)
+    if not catalog.load():
+        catalog.refresh()  # no snapshot, index once here so every worker starts with the same ids
+    print(f"Catalog has {len(catalog.tracks)} songs, starting {workers} workers")
+    UserStore().close()  # migrate data.json before the workers open the database
+
+    children = {}  # pid -> worker number
+
+    def start(worker):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(catalog, worker, workers)
+        children[pid] = worker
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    for worker in range(workers):
+        start(worker)
+    try:
+        while True:
+            pid, status = os.wait()
+            worker = children.pop(pid)
+            # its clients' sessions are lost, and the kernel may move some clients of other workers meanwhile
+            print(f"Worker {worker} exited with status {status}, restarting")
+            time.sleep(WORKER_RESTART_DELAY)
+            start(worker)
+    except KeyboardInterrupt:
+        for pid in children:
             try:
-                with open(song_path, 'rb') as file:
-                    send_message("start_streaming", client_address)
-                    chunk_size = 4096 #set size for data chunks
-                
-                    while True:
-                        chunk = file.read(chunk_size) #read chunk from file
-                        if not chunk:
-                            break
-                        server_socket.sendto(chunk, client_address) #send chunk to client 
-                        time.sleep(0.001)
-
-                    send_message("end_streaming", client_address)
-                    
-            except Exception as e:
-                print(f"Error streaming song: {e}")
-                send_message(f"error: {str(e)}", client_address)
-
-
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    workers = SERVER_WORKERS or os.cpu_count() or 1
+    if workers > 1 and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+        print("SERVER_WORKERS needs fork and SO_REUSEPORT, running a single process")
+        workers = 1
+    try:
+        if workers > 1:
+            run_workers(workers)
         else:
-            pass
-
-
+            asyncio.run(serve(Catalog(music_folder_path)))
     except KeyboardInterrupt:
         print("Server shutting down...")
-        break
-
-server_socket.close()
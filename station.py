@@ -0,0 +1,146 @@
+import os
+import time
+import random
+import socket
+import asyncio
+from collections import deque
+
+from mp3index import index_frames
+from streaming import CHUNK_SIZE, FLAG_LAST, pack_packet, next_stream_id
+
+STATION_GROUP = os.getenv("STATION_GROUP")  # "239.255.77.1:5001" multicasts the station, unset sends it to each listener
+STATION_TTL = int(os.getenv("STATION_TTL", 1))  # routers a multicast packet may cross, 1 stays on the local network
+LISTENER_TIMEOUT = 60  # seconds a listener stays subscribed without joining again
+ANNOUNCE_INTERVAL = 5  # seconds between now_playing messages, so listeners who join late learn the song
+IDLE_RETRY = 1  # seconds between looks at an empty catalog, the first refresh fills it soon after startup
+SKIP_DELAY = 1  # seconds to wait after a song that can't be played, a folder of broken files doesn't spin
+
+
+def parse_group(text):  # "239.255.77.1:5001" -> ("239.255.77.1", 5001)
+    host, _, port = text.rpartition(":")
+    return host, int(port)
+
+
+def enable_multicast(sock, interface):  # Send the station out of the interface the server listens on
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, STATION_TTL)
+    address = socket.gethostbyname(interface)
+    if address != "0.0.0.0":
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(address))
+
+
+def load_program(path):  # Read a song once and cut it into packets of whole frames: data, [(start, end, frames)], frame seconds
+    with open(path, 'rb') as file:
+        data = file.read()
+    index = index_frames(data)
+    end = len(data) - (128 if data[-128:-125] == b"TAG" else 0)  # ID3v1 tag
+    bounds = list(index.offsets) + [end]  # the ID3v2 tag before the first frame is never sent
+    packets = []
+    first = 0
+    for last in range(1, len(bounds)):
+        if bounds[last] - bounds[first] > CHUNK_SIZE and last - 1 > first:
+            packets.append((bounds[first], bounds[last - 1], last - 1 - first))
+            first = last - 1
+    if first < len(bounds) - 1:
+        packets.append((bounds[first], bounds[-1], len(bounds) - 1 - first))
+    return data, packets, index.frame_seconds
+
+
+class Station:  # Catalog songs played once in real time, every packet goes to all listeners or to one multicast group
+    def __init__(self, catalog, transport, group=None):
+        self.catalog = catalog
+        self.transport = transport
+        self.group = group  # (address, port) of the multicast group, or None to send to each listener
+        self.listeners = {}  # client_address -> time of its last join
+        self.queue = deque()  # track ids still to play in this round
+        self.track = None  # song on air
+        self.stream_id = None
+        self.started = 0.0  # loop time the song on air began
+        self.length = 0.0
+        self.last_announce = 0.0
+        self.packets_sent = 0  # datagrams, one per packet with multicast, one per listener and packet without
+        self.bytes_sent = 0
+
+    def join(self, client_address):  # Subscribe or renew, return the replies for the client
+        self.listeners[client_address] = time.monotonic()
+        group = f"{self.group[0]}:{self.group[1]}" if self.group else "-"
+        replies = [self.now_playing()] if self.track is not None else []
+        replies.append(f"station_joined {group}")  # last, a multicast listener stops reading this socket after it
+        return replies  # audio follows with the next packet, which starts on a frame
+
+    def leave(self, client_address):
+        self.listeners.pop(client_address, None)
+
+    def expire_listeners(self):  # Forget listeners that went away without leaving
+        deadline = time.monotonic() - LISTENER_TIMEOUT
+        for address in [address for address, joined in self.listeners.items() if joined < deadline]:
+            del self.listeners[address]
+
+    def now_playing(self):
+        position = asyncio.get_running_loop().time() - self.started
+        return (f"now_playing {self.stream_id} {self.track.track_id} {position:.1f} {self.length:.1f} "
+                f"{self.track.bitrate} {self.track.title}")
+
+    def send(self, data):
+        if self.group is not None:
+            self.transport.sendto(data, self.group)  # the network copies it to every member
+            self.packets_sent += 1
+            self.bytes_sent += len(data)
+            return
+        for address in self.listeners:
+            self.transport.sendto(data, address)
+        self.packets_sent += len(self.listeners)
+        self.bytes_sent += len(data) * len(self.listeners)
+
+    def announce(self):
+        self.expire_listeners()
+        self.send(self.now_playing().encode())
+        self.last_announce = time.monotonic()
+
+    def next_track(self):  # Next song of a shuffled round through the catalog, None if it is empty
+        if not self.queue:
+            track_ids = [track.track_id for track in self.catalog.ordered]
+            random.shuffle(track_ids)
+            self.queue.extend(track_ids)
+        while self.queue:
+            track = self.catalog.by_id.get(self.queue.popleft())  # may have been removed since the round began
+            if track is not None:
+                return track
+        return None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            track = self.next_track()
+            if track is None:
+                await asyncio.sleep(IDLE_RETRY)
+                continue
+            try:
+                data, packets, frame_seconds = await loop.run_in_executor(None, load_program, track.path)
+            except OSError as e:
+                print(f"Station skipping {track.path}: {e}")
+                packets = None
+            if not packets or not frame_seconds:
+                await asyncio.sleep(SKIP_DELAY)
+                continue
+            await self.play(track, data, packets, frame_seconds)
+
+    async def play(self, track, data, packets, frame_seconds):  # Send each packet when its audio is due
+        loop = asyncio.get_running_loop()
+        self.track = track
+        self.stream_id = next_stream_id()
+        self.started = loop.time()
+        self.length = sum(frames for _, _, frames in packets) * frame_seconds
+        self.announce()
+        view = memoryview(data)
+        played = 0  # frames sent so far
+        last = len(packets) - 1
+        for seq, (start, end, frames) in enumerate(packets):
+            delay = self.started + played * frame_seconds - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.group is not None or self.listeners:
+                self.send(pack_packet(self.stream_id, seq, FLAG_LAST if seq == last else 0, view[start:end]))
+            played += frames
+            if time.monotonic() - self.last_announce >= ANNOUNCE_INTERVAL:
+                self.announce()
+        await asyncio.sleep(max(0, self.started + played * frame_seconds - loop.time()))  # the last packet plays out
@@ -0,0 +1,292 @@
+import asyncio
+import itertools
+import os
+import struct
+import time
+from collections import OrderedDict
+
+# Header in front of every audio datagram: magic, version, flags, stream id, sequence number
+PACKET_HEADER = struct.Struct("!2sBBII")
+PACKET_MAGIC = b"MS"
+PACKET_VERSION = 1
+FLAG_RETRANSMIT = 0x01  # packet is a resend of an earlier sequence number
+FLAG_LAST = 0x02  # packet carries the final chunk of the song
+FLAG_PARITY = 0x04  # packet is the XOR of a group of chunks, its sequence number is the group's first
+PARITY_LENGTH = struct.Struct("!H")  # XOR of the chunk lengths, in front of a parity payload
+
+CHUNK_SIZE = 4096  # audio bytes per packet
+SEND_WINDOW = 256  # recently sent packets kept in memory for retransmission
+MAX_RETRANSMIT_PER_NACK = 512  # cap on packets resent for a single nack
+STREAM_LINGER = 30  # seconds a finished stream keeps answering nacks
+FEC_MIN_GROUP = 2  # smallest parity group a client may ask for, 50% overhead
+FEC_MAX_GROUP = 32  # largest, a gap this long is nacked anyway
+
+# Pacing: send the first seconds of a song fast to fill the client buffer, then settle near playback rate
+DEFAULT_BITRATE = 320000  # bits per second assumed when the mp3 header can't be read
+PACE_BURST_SECONDS = float(os.getenv("PACE_BURST_SECONDS", 10))  # seconds of audio sent at burst speed
+PACE_BURST_MULTIPLIER = float(os.getenv("PACE_BURST_MULTIPLIER", 8))  # burst speed as a multiple of the bitrate
+PACE_STEADY_MULTIPLIER = float(os.getenv("PACE_STEADY_MULTIPLIER", 1.25))  # speed after the burst, headroom for resends
+PACE_BUCKET_CHUNKS = 8  # packets that may leave back to back
+# Adaptive rate: the pacing rate is scaled down on reported loss and back up with every ack (AIMD)
+AIMD_INCREASE = 0.05  # scale added per ack, 1.0 is the full pacing rate
+AIMD_DECREASE = 0.5  # scale multiplied by this on loss
+AIMD_DECREASE_INTERVAL = 0.3  # seconds, one loss event often produces several nacks
+AIMD_MIN_MULTIPLIER = float(os.getenv("AIMD_MIN_MULTIPLIER", 1.0))  # slowest rate as a multiple of the bitrate
+WINDOW_STALL_TIMEOUT = 1.0  # seconds to wait for an ack that opens the window before probing with one packet
+INITIAL_WINDOW = 16  # packets sent before the client's first ack says how much it can buffer
+FIRST_ACK_TIMEOUT = 0.5  # seconds to wait for that ack, older clients never send one
+PREFETCH_MAX_MULTIPLIER = float(os.getenv("PREFETCH_MAX_MULTIPLIER", 4))  # fastest a client may ask a prefetch to run
+
+_stream_ids = itertools.count(1)
+
+
+def next_stream_id():  # Ids are unique across songs and stations, a client never mixes up their packets
+    return next(_stream_ids)
+
+
+def pack_packet(stream_id, seq, flags, chunk):
+    return PACKET_HEADER.pack(PACKET_MAGIC, PACKET_VERSION, flags, stream_id, seq) + chunk
+
+
+def parse_ranges(text):  # "4,5,9-11,20-" -> [(4, 4), (5, 5), (9, 11), (20, None)]
+    ranges = []
+    for part in text.split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            ranges.append((int(start), int(end) if end else None))
+        else:
+            ranges.append((int(part), int(part)))
+    return ranges
+
+
+def send_parts(transport, sock, parts, address):  # Send header and chunk as one datagram without joining them
+    if sock is not None and not transport.get_write_buffer_size():
+        try:
+            return sock.sendmsg(parts, [], 0, address)  # the kernel gathers the pieces
+        except (BlockingIOError, InterruptedError):
+            pass  # socket buffer full, let the transport queue a copy
+    packet = b"".join(parts)
+    transport.sendto(packet, address)
+    return len(packet)
+
+
+class Pacer:  # Token bucket metering a stream at a multiple of its bitrate
+    def __init__(self, bitrate, burst_seconds=None, burst_multiplier=None, steady_multiplier=None):
+        self.byte_rate = (bitrate or DEFAULT_BITRATE) / 8
+        self.burst_bytes = self.byte_rate * (PACE_BURST_SECONDS if burst_seconds is None else burst_seconds)
+        self.burst_multiplier = PACE_BURST_MULTIPLIER if burst_multiplier is None else burst_multiplier
+        self.steady_multiplier = PACE_STEADY_MULTIPLIER if steady_multiplier is None else steady_multiplier
+        self.capacity = CHUNK_SIZE * PACE_BUCKET_CHUNKS
+        self.tokens = self.capacity
+        self.sent = 0  # bytes charged so far
+        self.last = time.monotonic()
+        self.scale = 1.0  # AIMD share of the configured rate
+        self.last_decrease = 0.0
+
+    def rate(self):  # Bytes per second allowed right now
+        if self.sent < self.burst_bytes:
+            rate = self.byte_rate * self.burst_multiplier
+        else:
+            rate = self.byte_rate * self.steady_multiplier
+        return max(rate * self.scale, min(rate, self.byte_rate * AIMD_MIN_MULTIPLIER))  # never below real time
+
+    def increase(self):  # Client is keeping up
+        self.scale = min(1.0, self.scale + AIMD_INCREASE)
+
+    def decrease(self):  # Client lost packets, back off once per loss event
+        now = time.monotonic()
+        if now - self.last_decrease < AIMD_DECREASE_INTERVAL:
+            return
+        self.last_decrease = now
+        self.scale *= AIMD_DECREASE
+
+    def consume(self, size):  # Charge size bytes, return the seconds to wait before sending more
+        now = time.monotonic()
+        rate = self.rate()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * rate)
+        self.last = now
+        self.tokens -= size
+        self.sent += size
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / rate
+
+
+def prefetch_pacer(bitrate, share):  # Background download: no burst, a steady share of the bitrate
+    share = min(max(share, 0.1), PREFETCH_MAX_MULTIPLIER)
+    return Pacer(bitrate, burst_seconds=0, steady_multiplier=share)
+
+
+class SongStream:  # One song being sent to one client, with a window for retransmission
+    def __init__(self, transport, client_address, song_path, bitrate=None, start_offset=0, start_time=0.0, pacer=None,
+                 data=None, sock=None, fec_group=0, token=None, first_seq=0):
+        self.stream_id = next_stream_id()
+        self.token = token  # names the stream in a resume, None for streams that can't be resumed
+        self.transport = transport
+        self.sock = sock  # raw socket behind the transport, for scatter-gather sends
+        self.client_address = client_address
+        self.data = data  # whole song from the track cache, or None to read the file
+        self.file = open(song_path, 'rb') if data is None else None
+        self.start_offset = start_offset  # byte in the file where sequence number 0 begins
+        self.start_time = start_time  # song time at start_offset, in seconds
+        file_size = len(data) if data is not None else os.fstat(self.file.fileno()).st_size
+        self.size = max(0, file_size - start_offset)
+        self.header = bytearray(PACKET_HEADER.size)  # reused for every packet of a cached song
+        self.total_chunks = max(1, -(-self.size // CHUNK_SIZE))
+        self.window = OrderedDict()  # seq -> packet, oldest first
+        self.first_seq = first_seq  # non-zero when the stream resumes one that stalled, the client has what is before it
+        self.next_seq = first_seq  # first sequence number not sent yet
+        self.retransmits = 0
+        self.packets_sent = 0  # including resends, for the server metrics
+        self.bytes_sent = 0
+        self.fec_group = fec_group  # chunks per parity packet, 0 for no parity
+        self.parity = 0  # XOR of the current group's chunks, as one big integer
+        self.parity_lengths = 0
+        self.parity_sent = 0
+        self.recovered = 0  # chunks the client rebuilt from parity, from its acks
+        self.acked = first_seq  # packets the client has received without a gap
+        self.highest_acked = first_seq - 1  # newest sequence number the client has read
+        self.receive_window = None  # packets the client can buffer, None until it sends an ack
+        self.acks_expected = True  # False once the client turned out not to send acks
+        self.window_open = asyncio.Event()
+        self.pacer = pacer or Pacer(bitrate)
+        self.closed = False  # the client is done with it, nothing more is sent
+
+    def read_chunk(self, seq):
+        if self.data is not None:
+            start = self.start_offset + seq * CHUNK_SIZE
+            return self.data[start:start + CHUNK_SIZE]  # a view, the audio is not copied
+        self.file.seek(self.start_offset + seq * CHUNK_SIZE)
+        return self.file.read(CHUNK_SIZE)
+
+    def build_packet(self, seq, chunk, flags=0):
+        if seq == self.total_chunks - 1:
+            flags |= FLAG_LAST
+        return pack_packet(self.stream_id, seq, flags, chunk)
+
+    def send_cached(self, seq, chunk, flags=0):  # Send a chunk of a cached song, return the packet size
+        if seq == self.total_chunks - 1:
+            flags |= FLAG_LAST
+        PACKET_HEADER.pack_into(self.header, 0, PACKET_MAGIC, PACKET_VERSION, flags, self.stream_id, seq)
+        size = send_parts(self.transport, self.sock, (self.header, chunk), self.client_address)
+        self.packets_sent += 1
+        self.bytes_sent += size
+        return size
+
+    def send_next(self):  # Send the next chunk, return its size or 0 once the song is done
+        if self.closed or self.next_seq >= self.total_chunks:
+            return 0
+        seq = self.next_seq
+        self.next_seq += 1
+        chunk = self.read_chunk(seq)
+        if self.data is not None:
+            size = self.send_cached(seq, chunk)  # resends come from the cache too, no window needed
+        else:
+            packet = self.build_packet(seq, chunk)
+            self.transport.sendto(packet, self.client_address)
+            self.window[seq] = packet
+            if len(self.window) > SEND_WINDOW:
+                self.window.popitem(last=False)  # forget the oldest packet
+            self.packets_sent += 1
+            self.bytes_sent += len(packet)
+            size = len(packet)
+        if self.fec_group:
+            size += self.add_to_parity(seq, chunk)
+        return size
+
+    def add_to_parity(self, seq, chunk):  # Fold a chunk into its group's parity, send the parity once the group is full
+        self.parity ^= int.from_bytes(chunk, "big") << (8 * (CHUNK_SIZE - len(chunk)))  # short last chunk is zero padded
+        self.parity_lengths ^= len(chunk)
+        first = seq - seq % self.fec_group
+        if seq != first + self.fec_group - 1 and seq != self.total_chunks - 1:
+            return 0
+        packet = (PACKET_HEADER.pack(PACKET_MAGIC, PACKET_VERSION, FLAG_PARITY, self.stream_id, first)
+                  + PARITY_LENGTH.pack(self.parity_lengths) + self.parity.to_bytes(CHUNK_SIZE, "big"))
+        self.parity = 0
+        self.parity_lengths = 0
+        self.transport.sendto(packet, self.client_address)
+        self.parity_sent += 1
+        self.packets_sent += 1
+        self.bytes_sent += len(packet)
+        return len(packet)
+
+    def in_flight(self):  # Packets sent after the newest one the client has read, queued or lost
+        return self.next_seq - self.highest_acked - 1
+
+    def on_ack(self, contiguous, highest, free, recovered=0):  # Client reports progress and its free buffer space
+        self.recovered = max(self.recovered, recovered)
+        self.acked = max(self.acked, contiguous)
+        self.highest_acked = max(self.highest_acked, highest)
+        self.receive_window = free
+        self.pacer.increase()
+        while self.window and next(iter(self.window)) < self.acked:
+            self.window.popitem(last=False)  # the client has these, no resend will be needed
+        if self.in_flight() < free:
+            self.window_open.set()
+
+    def retransmit(self, ranges):  # Resend the sequence numbers a client reported missing
+        limit = MAX_RETRANSMIT_PER_NACK
+        if self.receive_window is not None:
+            limit = min(limit, max(1, self.receive_window - self.in_flight()))  # what the client can still buffer
+        sent = 0
+        for start, end in ranges:
+            if end is None or end >= self.next_seq:
+                end = self.next_seq - 1  # never resend what was not sent yet
+            end = min(end, max(start, 0) + limit - sent - 1)
+            for seq in range(max(start, 0), end + 1):
+                if self.data is not None:
+                    size = self.send_cached(seq, self.read_chunk(seq), FLAG_RETRANSMIT)
+                else:
+                    packet = self.window.get(seq)
+                    if packet is not None:
+                        packet = bytearray(packet)
+                        packet[3] |= FLAG_RETRANSMIT  # flags byte of the header
+                    else:
+                        packet = self.build_packet(seq, self.read_chunk(seq), FLAG_RETRANSMIT)  # fell out of the window
+                    self.transport.sendto(packet, self.client_address)
+                    size = len(packet)
+                    self.packets_sent += 1
+                    self.bytes_sent += size
+                self.pacer.consume(size)  # resends slow down the main loop instead of adding to it
+                sent += 1
+        self.retransmits += sent
+        if sent:
+            self.pacer.decrease()  # lost packets mean the path or the client is overloaded
+        return sent
+
+    async def run(self, send_message):
+        bitrate = int(self.pacer.byte_rate * 8)
+        start = (f"start_streaming {self.stream_id} {self.total_chunks} {bitrate} "
+                 f"{self.start_offset} {self.start_time:.3f} {self.fec_group} {self.token or '-'}")
+        send_message(start, self.client_address)
+        while True:
+            if self.receive_window is None:
+                if self.acks_expected and self.next_seq - self.first_seq >= INITIAL_WINDOW:
+                    self.window_open.clear()
+                    try:
+                        await asyncio.wait_for(self.window_open.wait(), FIRST_ACK_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        self.acks_expected = False  # pace the stream without flow control
+                        send_message(start, self.client_address)  # clients drop our packets until they have it
+            elif self.in_flight() >= self.receive_window:
+                self.window_open.clear()
+                try:
+                    await asyncio.wait_for(self.window_open.wait(), WINDOW_STALL_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self.pacer.decrease()  # acks stopped arriving, send one packet to probe
+            size = self.send_next()
+            if not size:
+                break
+            await asyncio.sleep(self.pacer.consume(size))  # always yields so other clients are served
+        if not self.closed:
+            send_message(f"end_streaming {self.stream_id} {self.total_chunks}", self.client_address)
+
+    def close(self):
+        self.closed = True
+        self.window_open.set()  # a run waiting for acks stops now
+        self.window.clear()
+        self.data = None
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,59 @@
+import os
+import threading
+from collections import OrderedDict
+
+TRACK_CACHE_BYTES = int(os.getenv("TRACK_CACHE_BYTES", 256 * 1024 * 1024))  # memory for whole songs kept in ram
+TRACK_CACHE_MAX_TRACK = 64 * 1024 * 1024  # larger files are always streamed from disk
+TRACK_CACHE_MIN_PLAYS = int(os.getenv("TRACK_CACHE_MIN_PLAYS", 2))  # streams of a song before it is kept in memory
+PLAY_COUNTS_KEPT = 4096  # songs whose stream count is remembered
+
+
+class TrackCache:  # Contents of hot songs, shared by every stream of them, least recently used evicted first
+    def __init__(self, budget=TRACK_CACHE_BYTES, max_track=TRACK_CACHE_MAX_TRACK, min_plays=TRACK_CACHE_MIN_PLAYS):
+        self.budget = budget
+        self.max_track = max_track
+        self.min_plays = min_plays
+        self.entries = OrderedDict()  # path -> (size, mtime, memoryview), least recently used first
+        self.plays = OrderedDict()  # path -> streams started while not cached
+        self.used = 0  # bytes held by entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # loaded from worker threads
+
+    def get(self, path):  # memoryview of the whole file if the song is hot, otherwise None
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            if entry is not None:
+                self.drop(path)  # file changed on disk
+
+            plays = self.plays.pop(path, 0) + 1
+            self.plays[path] = plays
+            while len(self.plays) > PLAY_COUNTS_KEPT:
+                self.plays.popitem(last=False)
+            if plays < self.min_plays or stat.st_size > min(self.max_track, self.budget):
+                return None
+
+        with open(path, 'rb') as file:
+            data = file.read()
+        if len(data) != stat.st_size:
+            return None  # file is being rewritten, try again on the next stream
+        view = memoryview(data)  # slices of it are sent without copying
+        with self.lock:
+            if path in self.entries:
+                self.drop(path)
+            self.entries[path] = (stat.st_size, stat.st_mtime, view)
+            self.used += stat.st_size
+            self.plays.pop(path, None)
+            while self.used > self.budget:
+                self.drop(next(iter(self.entries)))  # streams still sending it keep their own reference
+        return view
+
+    def drop(self, path):
+        size, _, _ = self.entries.pop(path)
+        self.used -= size
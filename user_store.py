@@ -0,0 +1,78 @@
+import os
+import json
+import sqlite3
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+USER_DB = "users.db"
+LEGACY_USER_FILE = "data.json"  # old store, migrated into USER_DB once
+INDEX_SIZE = 100000  # user records kept in memory
+
+
+class UserStore:  # Users keyed by name, in SQLite with an in-memory index in front
+    def __init__(self, path=USER_DB, legacy_path=LEGACY_USER_FILE):
+        # after startup only the store's thread uses the connection, an fsync'd insert never holds up the loop
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)  # autocommit, every insert is its own transaction
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="userdb")
+        self.db.execute("PRAGMA journal_mode=WAL")  # readers never wait for a writer
+        self.db.execute("PRAGMA synchronous=FULL")  # a confirmed registration survives a power cut
+        self.db.execute("CREATE TABLE IF NOT EXISTS users ("
+                        "name TEXT PRIMARY KEY, pswd TEXT NOT NULL, email TEXT NOT NULL)")
+        self.index = OrderedDict()  # name -> record, least recently used first
+        self.migrate(legacy_path)
+
+    def migrate(self, legacy_path):  # Import data.json the first time the database is created
+        if not os.path.exists(legacy_path):
+            return
+        if self.db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None:
+            return  # already migrated
+        with open(legacy_path, 'r') as file:
+            users = json.load(file)
+        self.db.execute("BEGIN")
+        self.db.executemany("INSERT OR IGNORE INTO users (name, pswd, email) VALUES (?, ?, ?)",
+                            [(obj["name"], obj["pswd"], obj["email"]) for obj in users])  # first of duplicate names wins
+        self.db.execute("COMMIT")
+        os.replace(legacy_path, legacy_path + ".migrated")  # keep the old file, but don't import it twice
+        print(f"Migrated {len(users)} users from {legacy_path}")
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def read(self, name):  # On the store's thread
+        row = self.db.execute("SELECT name, pswd, email FROM users WHERE name = ?", (name,)).fetchone()
+        return {'name': row[0], 'pswd': row[1], 'email': row[2]} if row is not None else None
+
+    def insert(self, name, pswd, email):  # On the store's thread, False if the name is taken
+        cursor = self.db.execute("INSERT OR IGNORE INTO users (name, pswd, email) VALUES (?, ?, ?)",
+                                 (name, pswd, email))
+        return cursor.rowcount == 1
+
+    async def get(self, name):  # {'name', 'pswd', 'email'} or None, the index is only touched on the loop thread
+        record = self.index.get(name)
+        if record is not None:
+            self.index.move_to_end(name)
+            return record
+        record = await self.run(self.read, name)
+        if record is not None:
+            self.remember(record)
+        return record
+
+    async def exists(self, name):
+        return await self.get(name) is not None
+
+    async def add(self, name, pswd, email):  # Return False if the name is taken
+        if not await self.run(self.insert, name, pswd, email):
+            return False
+        self.remember({'name': name, 'pswd': pswd, 'email': email})
+        return True
+
+    def remember(self, record):
+        self.index[record['name']] = record
+        self.index.move_to_end(record['name'])
+        if len(self.index) > INDEX_SIZE:
+            self.index.popitem(last=False)
+
+    def close(self):
+        self.executor.shutdown(wait=True)  # let a running insert finish
+        self.db.close()